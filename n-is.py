@@ -1,26 +1,37 @@
 import os
+import sys
 import curses
+import time
 import random
-from math import floor
+import mmap
+import json
+import fcntl
+import struct
+import termios
+import hashlib
+import threading
+import functools
+import gc
+import collections
+import contextlib
+from math import floor, log2
 import argparse as arg
 import polyshapes as ps
 
-# Try to import pygame for audio support
-try:
-    import pygame
-    import numpy as np
-    PYGAME_AVAILABLE = True
-except ImportError:
-    PYGAME_AVAILABLE = False
-    pygame = None
-    np = None
+# asyncio is imported by main_async, only the --asyncio loop needs it
+asyncio = None
+
+# pygame and numpy for audio support are imported by load_audio, on a background thread
+PYGAME_AVAILABLE = False
+pygame = None
+np = None
 
 # constants
 BLOCK_CHAR = "█"
 BORDER_CHAR = "║"
 TOP_BOTTOM_BORDER_CHAR = "═"
 CORNER_CHAR = "╔╗╚╝"
-GAME_NAMES = ["Mono", "D", "Tr", "Tetr", "Pent", "Hex"]
+GAME_NAMES = ["Mono", "D", "Tr", "Tetr", "Pent", "Hex", "Hept", "Oct"]
 
 # ASCII Art for menus
 TETRIS_LOGO = [
@@ -62,6 +73,34 @@ MENU_BORDER_BOTTOM = "╚══════════════════
 MENU_BORDER_SIDE = "║"
 
 # argument parsing
+QUALITY_FEATURES = ("ghost", "preview", "sound")
+
+
+def degrade_order(text):
+    """Parse the --degrade order of features."""
+    order = tuple(name.strip() for name in text.split(",") if name.strip())
+    unknown = [name for name in order if name not in QUALITY_FEATURES]
+    if unknown or len(set(order)) != len(order):
+        raise arg.ArgumentTypeError(f"expected a comma separated order of {', '.join(QUALITY_FEATURES)}")
+    return order
+
+
+def non_negative_int(text):
+    """Parse a whole number that may be 0."""
+    value = int(text)
+    if value < 0:
+        raise arg.ArgumentTypeError(f"expected 0 or more, got {text}")
+    return value
+
+
+def positive_int(text):
+    """Parse a whole number above 0."""
+    value = int(text)
+    if value <= 0:
+        raise arg.ArgumentTypeError(f"expected 1 or more, got {text}")
+    return value
+
+
 parser = arg.ArgumentParser(
     description="Dis/Tris/Tetris/Pentis/Hexis game implementation in Python using curses; use arrow keys to move blocks, 'q' to quit.")
 parser.add_argument("n", type=int, nargs='?',
@@ -74,6 +113,56 @@ parser.add_argument(
     "-bc", type=int, help="same as -c, but for background color, only numbers accepted.")
 parser.add_argument("-m", action="store_true",
                     help="enable mix mode, includes polyominos/polykings with less than n blocks")
+parser.add_argument("--weights", type=str, default="shape",
+                    help="piece probabilities in mix mode; 'shape' gives every shape the same chance (default), 'order' gives every order the same chance,\
+    a comma separated list like 1,1,2,4 sets a weight per order (1..n), and a list with one value per shape sets per-shape weights")
+parser.add_argument("--shapes", type=str, metavar="FILE",
+                    help="play with a custom shape set from a binary shape-set file (see --export-shapes), -e and -m are ignored")
+parser.add_argument("--export-shapes", type=str, metavar="FILE",
+                    help="write the selected shape set to a binary shape-set file and exit; n above 6 generates the polyominos/polykings")
+parser.add_argument("--analyze", type=str, nargs="?", const="n-is-analysis.json", metavar="REPORT",
+                    help="analyze every shape set (and generated sets up to n, if n is above 6) in a process pool, print the statistics and cache them in REPORT")
+parser.add_argument("--jobs", type=positive_int, default=os.cpu_count(),
+                    help="number of worker processes for --analyze (default: all cores)")
+parser.add_argument("--renderer", choices=["curses", "ansi"], default="curses",
+                    help="screen output backend; 'curses' (default) or 'ansi', which writes escape sequences directly with one write per frame")
+parser.add_argument("--benchmark", type=int, nargs="?", const=2000, metavar="FRAMES",
+                    help="run a rendering benchmark of FRAMES frames (default 2000) for every n and renderer, curses draws on a pseudo terminal so no terminal is needed")
+parser.add_argument("--spectate", type=int, metavar="GAMES",
+                    help="watch GAMES bot games tiled in one terminal at one character per cell")
+parser.add_argument("--half-blocks", action="store_true",
+                    help="with --spectate, draw two board rows per character using half-block characters")
+parser.add_argument("--adaptive", action="store_true",
+                    help="skip frames while the terminal has not caught up with the output (slow SSH or tmux links); the game itself keeps full speed")
+parser.add_argument("--fps", type=positive_int, default=60,
+                    help="frames drawn per second at most, the game logic always runs at 50 ticks per second")
+parser.add_argument("--das", type=non_negative_int, default=None, metavar="MS",
+                    help="delayed auto shift: hold left or right this long before the piece starts sliding (default: terminal key repeat);\
+    terminals report no key releases, so the sliding never starts before the terminal's own key repeat delay")
+parser.add_argument("--arr", type=non_negative_int, default=40, metavar="MS",
+                    help="auto repeat rate with --das, time between shifts; 0 slides straight to the wall")
+parser.add_argument("--sdf", type=positive_int, default=20,
+                    help="soft drop factor with --das, gravity is this many times faster while down is held")
+parser.add_argument("--asyncio", action="store_true",
+                    help="run input, gravity, drawing and sound as asyncio tasks instead of one blocking loop")
+parser.add_argument("--max-keys", type=non_negative_int, default=0,
+                    help="keys handled at most per frame, the rest wait for the next one (default: all queued keys)")
+parser.add_argument("--stats", action="store_true",
+                    help="show live timings of input, logic, ghost, rendering and sound per frame, and print their histograms on exit")
+parser.add_argument("--frame-budget", type=float, metavar="MS",
+                    help="milliseconds a frame may take before the ghost, preview redraws and minor sounds are dropped to keep up")
+parser.add_argument("--degrade", type=degrade_order, default=("ghost", "preview", "sound"), metavar="ORDER",
+                    help="comma separated order in which --frame-budget drops features (default: ghost,preview,sound)")
+parser.add_argument("--piece-colors", action="store_true",
+                    help="give every shape its own color instead of drawing all blocks in the main color")
+parser.add_argument("--no-sound", action="store_true",
+                    help="skip audio entirely, pygame and numpy are not even imported")
+parser.add_argument("--seed", type=int,
+                    help="seed for the piece generator, the same seed gives the same sequence of pieces")
+parser.add_argument("--bag", action="store_true",
+                    help="deal pieces from a shuffled bag holding every shape once, instead of drawing them independently (ignores --weights)")
+parser.add_argument("--preview", type=positive_int, default=1,
+                    help="number of upcoming pieces kept in the preview queue (default 1)")
 
 args = parser.parse_args()
 
@@ -82,7 +171,12 @@ add_text = ""
 level = 0
 total_lines = 0
 next_shape = None
+next_color = 1
+generator = None
+coalescer = None
+color_pairs = None
 held_shape = None
+held_color = 1
 can_hold = True
 combo_count = 0
 last_action_was_clear = False
@@ -91,22 +185,114 @@ sound_enabled = False
 sound_on = True
 is_paused = False
 vol = 0
+loaded_music = None
+NO_MUSIC = "no music"  # wanted while the menu shows: get the mixer ready, play nothing yet
+audio_lock = threading.Lock()
+audio_busy = False
+wanted_music = NO_MUSIC
+stats = None
+quality = None
+
+
+def load_audio():
+    """Import pygame and numpy on first use, return True if sound is possible."""
+    global pygame, np, PYGAME_AVAILABLE
+    if PYGAME_AVAILABLE:
+        return True
+    if args.no_sound:
+        return False
+    # the import greeting would land in the middle of the curses screen
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    try:
+        import pygame
+        import numpy as np
+    except ImportError:
+        return False
+    PYGAME_AVAILABLE = True
+    return True
+
+
+def start_sound(selected_music=None):
+    """
+    Initialize audio and the selected music on a background thread, so the
+    menu or the first frames do not wait for it. Sounds are skipped until
+    the mixer is ready.
+    """
+    global wanted_music, audio_busy
+    if args.no_sound:
+        return
+    with audio_lock:
+        wanted_music = selected_music
+        if audio_busy:
+            return  # the running worker picks up the new selection
+        audio_busy = True
+    threading.Thread(target=audio_worker, daemon=True).start()
+
+
+def audio_worker():
+    """Run init_sound until the music it loaded is still the one wanted."""
+    global audio_busy
+    while True:
+        with audio_lock:
+            music = wanted_music
+        init_sound(music)
+        with audio_lock:
+            if wanted_music == music:
+                audio_busy = False
+                return
+
+
+def timed(phase):
+    """
+    Decorator adding the run time of a function to phase of the --stats
+    timings. Without --stats the function is returned untouched.
+    """
+    def decorate(func):
+        if not args.stats:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*func_args, **kwargs):
+            stats.begin(phase)
+            try:
+                return func(*func_args, **kwargs)
+            finally:
+                stats.end()
+        return wrapper
+    return decorate
 
 
 def init_sound(selected_music=None):
     """Initialize pygame mixer for sound effects."""
     global sound_enabled
     global vol
+    global loaded_music
 
-    if not PYGAME_AVAILABLE:
+    if not load_audio():
         sound_enabled = False
         return
 
+    # a new game in the same session keeps the mixer and the music,
+    # which only needs starting again after sound_game_over stopped it
+    if sound_enabled and selected_music == loaded_music:
+        if selected_music != NO_MUSIC:
+            try:
+                if not pygame.mixer.music.get_busy():
+                    pygame.mixer.music.set_volume(vol)
+                    pygame.mixer.music.play(-1)
+            except pygame.error:
+                pass
+        return
+
     try:
         pygame.mixer.pre_init(frequency=22050, size=-
                               16, channels=2, buffer=512)
         pygame.mixer.init()
         vol = 0.05
+        if selected_music == NO_MUSIC:
+            loaded_music = NO_MUSIC
+            sound_enabled = True
+            return
 
         # Load background music based on selection
         music_folder = os.path.join(os.path.dirname(__file__), "music")
@@ -132,6 +318,7 @@ def init_sound(selected_music=None):
             pygame.mixer.music.load(music_file)
             pygame.mixer.music.set_volume(vol)
             pygame.mixer.music.play(-1)  # Loop indefinitely
+        loaded_music = selected_music
         sound_enabled = True
     except (pygame.error, ImportError):
         sound_enabled = False
@@ -139,7 +326,10 @@ def init_sound(selected_music=None):
 
 def cleanup_sound():
     """Clean up pygame mixer."""
+    global sound_enabled, loaded_music
     if sound_enabled and PYGAME_AVAILABLE:
+        sound_enabled = False
+        loaded_music = None
         try:
             pygame.mixer.music.stop()
             pygame.mixer.quit()
@@ -179,6 +369,7 @@ def generate_simple_tone(frequency, duration, wave_type='sine', volume=0.15):
         return None
 
 
+@timed("sound")
 def play_sound_effect(frequency, duration=100, wave_type='sine', volume=0.15):
     """Play a simple sound effect."""
     if not sound_enabled or not sound_on or not PYGAME_AVAILABLE:
@@ -222,16 +413,22 @@ def sound_line_clear(lines):
 
 def sound_piece_lock():
     """Play sound when piece locks."""
+    if quality and quality.skips("sound"):
+        return
     play_sound_effect(196, 60, 'triangle', 0.06)  # G3
 
 
 def sound_piece_move():
     """Play sound when piece moves."""
+    if quality and quality.skips("sound"):
+        return
     play_sound_effect(330, 30, 'triangle', 0.04)  # E4
 
 
 def sound_piece_rotate():
     """Play sound when piece rotates."""
+    if quality and quality.skips("sound"):
+        return
     play_sound_effect(440, 40, 'triangle', 0.05)  # A4
 
 
@@ -269,6 +466,18 @@ def sound_game_over():
     play_sound_effect(196, 600, 'sine', 0.10)
 
 
+sound_queue = None  # jingles queued for the sound task of the asyncio loop
+
+
+@timed("sound")
+def play_jingle(func, *args):
+    """Play a sound that waits between its notes, through the sound task if one runs."""
+    if sound_queue is not None:
+        sound_queue.put_nowait((func, args))
+    else:
+        func(*args)
+
+
 def toggle_all_sound():
     """Toggle all sound effects and music on/off."""
     global sound_on
@@ -309,8 +518,9 @@ def show_option_menu(stdscr, title, options, option_texts, selected_info=""):
         max_y, max_x = stdscr.getmaxyx()
 
         # draw decorative border
-        stdscr.addstr(2, (max_x - len(MENU_BORDER_TOP)) // 2,
-                      MENU_BORDER_TOP, curses.color_pair(1))
+        if 2 < max_y - 1 and len(MENU_BORDER_TOP) < max_x:
+            stdscr.addstr(2, (max_x - len(MENU_BORDER_TOP)) // 2,
+                          MENU_BORDER_TOP, curses.color_pair(1))
 
         # instructions
         instruction_text = "Use ↑↓ arrows to navigate, Enter to select, Q to quit"
@@ -355,7 +565,7 @@ def show_option_menu(stdscr, title, options, option_texts, selected_info=""):
 
         # bottom border
         bottom_y = start_y + 5 + len(option_texts)
-        if bottom_y < max_y - 1:
+        if bottom_y < max_y - 1 and len(MENU_BORDER_BOTTOM) < max_x:
             stdscr.addstr(bottom_y, (max_x - len(MENU_BORDER_BOTTOM)) //
                           2, MENU_BORDER_BOTTOM, curses.color_pair(1))
 
@@ -376,7 +586,7 @@ def show_option_menu(stdscr, title, options, option_texts, selected_info=""):
                 return options[n_value - 1]
 
 
-def show_menu(stdscr):
+def show_menu(stdscr, welcome=True):
     """Show enhanced menu with ASCII art to select n, ext and mix options."""
     global bcgd
     curses.curs_set(0)
@@ -387,9 +597,12 @@ def show_menu(stdscr):
     curses.init_pair(4, curses.COLOR_RED, bcgd)
     curses.init_pair(5, curses.COLOR_MAGENTA, bcgd)
 
-    # show welcome screen first
+    # show welcome screen first, not when coming back from a game
+    stdscr.bkgd(' ', 0)
     stdscr.clear()
     max_y, max_x = stdscr.getmaxyx()
+    if not welcome:
+        return select_game_options(stdscr)
 
     # display ASCII art logo
     logo_start_y = max(1, (max_y - len(TETRIS_LOGO) - 8) // 2)
@@ -404,20 +617,26 @@ def show_menu(stdscr):
 
     msg_y = logo_start_y + len(TETRIS_LOGO) + 2
     if msg_y < max_y - 3:
-        stdscr.addstr(msg_y, (max_x - len(welcome_msg)) // 2,
-                      welcome_msg, curses.color_pair(2) | curses.A_BOLD)
-        stdscr.addstr(msg_y + 1, (max_x - len(subtitle)) //
-                      2, subtitle, curses.color_pair(3))
+        if len(welcome_msg) < max_x:
+            stdscr.addstr(msg_y, (max_x - len(welcome_msg)) // 2,
+                          welcome_msg, curses.color_pair(2) | curses.A_BOLD)
+        if len(subtitle) < max_x:
+            stdscr.addstr(msg_y + 1, (max_x - len(subtitle)) //
+                          2, subtitle, curses.color_pair(3))
 
     # continue prompt
     continue_msg = "Press any key to continue..."
-    if msg_y + 4 < max_y - 1:
+    if msg_y + 4 < max_y - 1 and len(continue_msg) < max_x:
         stdscr.addstr(msg_y + 4, (max_x - len(continue_msg)) // 2,
                       continue_msg, curses.color_pair(1) | curses.A_BLINK)
 
     stdscr.refresh()
     stdscr.getch()  # wait for key press
+    return select_game_options(stdscr)
+
 
+def select_game_options(stdscr):
+    """Ask for n, ext, mix and music, return None for all when cancelled."""
     # select game type
     n_options = [1, 2, 3, 4, 5, 6]
     n_texts = [f"{n} - {GAME_NAMES[i]}is" for i, n in enumerate(n_options)]
@@ -458,49 +677,266 @@ def show_menu(stdscr):
     return selected_n, selected_ext, selected_mix, selected_music
 
 
+class AliasSampler:
+    """Weighted sampler using Vose's alias method, every draw is O(1)."""
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        if n == 0 or total <= 0 or min(weights) < 0:
+            raise ValueError("weights must be non-negative and not all zero")
+
+        scaled = [w * n / total for w in weights]
+        prob = [0.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+        # pair every underfull column with an overfull one
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] += scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+
+        # whatever is left is full up to rounding errors
+        for i in small + large:
+            prob[i] = 1.0
+
+        self.n = n
+        self.prob = prob
+        self.alias = alias
+
+    def draw(self, rng=random):
+        """Return a random index distributed according to the weights."""
+        u = rng.random() * self.n
+        i = int(u)
+        return i if u - i < self.prob[i] else self.alias[i]
+
+
+SHAPESET_MAGIC = b"NISH"
+SHAPESET_VERSION = 1
+# magic, version, highest order, number of shapes
+SHAPESET_HEADER = struct.Struct("<4sHHI")
+SHAPESET_OFFSET = struct.Struct("<I")
+# order, height, width, followed by the packed cells
+SHAPESET_RECORD = struct.Struct("<BBB")
+
+
+def write_shape_set(path, shapes, orders=None):
+    """
+    Write shapes to a binary shape-set file: a header, a table of count + 1
+    record offsets and one record per shape with its cells packed row by row,
+    most significant bit first.
+    """
+    records = []
+    for i, shape in enumerate(shapes):
+        height, width = len(shape), len(shape[0])
+        order = orders[i] if orders else sum(map(sum, shape))
+        size = (height * width + 7) // 8
+        bits = 0
+        for row in shape:
+            for cell in row:
+                bits = (bits << 1) | (1 if cell else 0)
+        bits <<= size * 8 - height * width
+        records.append(SHAPESET_RECORD.pack(order, height, width) +
+                       bits.to_bytes(size, "big"))
+
+    max_order = max((r[0] for r in records), default=0)
+    offset = SHAPESET_HEADER.size + SHAPESET_OFFSET.size * (len(records) + 1)
+    with open(path, "wb") as f:
+        f.write(SHAPESET_HEADER.pack(SHAPESET_MAGIC, SHAPESET_VERSION,
+                                     max_order, len(records)))
+        for record in records:
+            f.write(SHAPESET_OFFSET.pack(offset))
+            offset += len(record)
+        f.write(SHAPESET_OFFSET.pack(offset))
+        for record in records:
+            f.write(record)
+
+
+class ShapeSetFile:
+    """
+    Read-only shape set backed by an mmap of a shape-set file. Shapes are
+    decoded when indexed, forked processes share the mapped pages.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < SHAPESET_HEADER.size:
+            raise ValueError(f"{path}: not a shape-set file")
+        magic, version, self.max_order, self.count = SHAPESET_HEADER.unpack_from(
+            self.map, 0)
+        if magic != SHAPESET_MAGIC or version != SHAPESET_VERSION:
+            raise ValueError(f"{path}: not a shape-set file")
+        self.check(path)
+
+    def check(self, path):
+        """Raise ValueError unless the offset table and every record fit the file."""
+        end = SHAPESET_HEADER.size + SHAPESET_OFFSET.size * (self.count + 1)
+        if len(self.map) < end:
+            raise ValueError(f"{path}: truncated shape-set file")
+        for i in range(self.count):
+            start, next_start = self.record_offset(i), self.record_offset(i + 1)
+            if start < end or next_start > len(self.map) or next_start - start < SHAPESET_RECORD.size:
+                raise ValueError(f"{path}: bad offset of shape {i}")
+            _, height, width = SHAPESET_RECORD.unpack_from(self.map, start)
+            if not height or not width or next_start - start != SHAPESET_RECORD.size + (height * width + 7) // 8:
+                raise ValueError(f"{path}: bad record of shape {i}")
+            end = next_start
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("shape index out of range")
+        start = self.record_offset(i)
+        _, height, width = SHAPESET_RECORD.unpack_from(self.map, start)
+        start += SHAPESET_RECORD.size
+        size = (height * width + 7) // 8
+        bits = int.from_bytes(self.map[start:start + size], "big")
+        cells = format(bits >> (size * 8 - height * width), "b").zfill(height * width)
+        return [[int(c) for c in cells[y * width:(y + 1) * width]] for y in range(height)]
+
+    def record_offset(self, i):
+        return SHAPESET_OFFSET.unpack_from(self.map, SHAPESET_HEADER.size + SHAPESET_OFFSET.size * i)[0]
+
+    def order(self, i):
+        """Return the order of the i-th shape without decoding it."""
+        return self.map[self.record_offset(i)]
+
+    def orders(self):
+        return [self.order(i) for i in range(self.count)]
+
+
+def normalize_cells(cells):
+    """Translate cells so the smallest x and y are 0 and return them sorted."""
+    min_x = min(x for x, _ in cells)
+    min_y = min(y for _, y in cells)
+    return tuple(sorted((x - min_x, y - min_y) for x, y in cells))
+
+
+def canonical_cells(cells):
+    """Smallest normalized form among the 4 rotations, mirror images stay distinct."""
+    forms = []
+    for _ in range(4):
+        cells = [(-y, x) for x, y in cells]
+        forms.append(normalize_cells(cells))
+    return min(forms)
+
+
+def generate_polyforms(n, kings=False):
+    """
+    Generate all one-sided polyominos (or polykings) with n blocks by growing
+    the (n-1)-block ones a cell at a time.
+    """
+    if kings:
+        steps = [(dx, dy) for dx in (-1, 0, 1)
+                 for dy in (-1, 0, 1) if dx or dy]
+    else:
+        steps = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+
+    forms = {((0, 0),)}
+    for _ in range(n - 1):
+        grown = set()
+        for form in forms:
+            occupied = set(form)
+            for x, y in form:
+                for dx, dy in steps:
+                    cell = (x + dx, y + dy)
+                    if cell not in occupied:
+                        grown.add(canonical_cells(form + (cell,)))
+        forms = grown
+
+    shapes = []
+    for form in sorted(forms):
+        width = max(x for x, _ in form) + 1
+        height = max(y for _, y in form) + 1
+        shape = [[0] * width for _ in range(height)]
+        for x, y in form:
+            shape[y][x] = 1
+        shapes.append(shape)
+    return shapes
+
+
+def shapes_for_order(k, ext):
+    """Return the shape set with k blocks, sets above hexis are generated."""
+    if 2*k <= len(ps.poly):
+        return ps.poly[2*k - 1] if ext else ps.poly[2*k - 2]
+    return generate_polyforms(k, kings=ext)
+
+
+def shape_weights(orders, spec="shape"):
+    """
+    Turn a --weights spec into one weight per shape.
+    orders holds the order (block count) of every shape in SHAPES.
+    """
+    if spec == "shape":
+        return [1.0] * len(orders)
+
+    counts = {}
+    for k in orders:
+        counts[k] = counts.get(k, 0) + 1
+
+    if spec == "order":
+        # every order gets the same total probability
+        return [1.0 / counts[k] for k in orders]
+
+    try:
+        values = [float(v) for v in spec.split(",")]
+    except ValueError:
+        raise ValueError(f"invalid weights: {spec}")
+
+    max_order = max(orders)
+    if len(values) == max_order:
+        # per order weights, split evenly between shapes of that order
+        return [values[k - 1] / counts[k] for k in orders]
+    if len(values) == len(orders):
+        return values
+    raise ValueError(
+        f"expected {max_order} per-order or {len(orders)} per-shape weights, got {len(values)}")
+
+
 def initialize_shapes_and_dimensions():
     """Initialize SHAPES, COLS, ROWS, name_of_game, and add_text based on args."""
-    global SHAPES, COLS, ROWS, name_of_game, add_text
-
-    if not args.m:
-        SHAPES = ps.poly[2*args.n - 1] if args.e else ps.poly[2*args.n - 2]
+    global SHAPES, SHAPE_ORDERS, SAMPLER, COLS, ROWS, name_of_game, add_text
+
+    if args.shapes:
+        SHAPES = ShapeSetFile(args.shapes)
+        SHAPE_ORDERS = SHAPES.orders()
+    elif not args.m:
+        SHAPES = shapes_for_order(args.n, args.e)
+        SHAPE_ORDERS = [args.n] * len(SHAPES)
     else:
         SHAPES = []
+        SHAPE_ORDERS = []
         for k in range(1, 1+args.n):
-            SHAPES = SHAPES + \
-                ps.poly[2*k - 1] if args.e else SHAPES + ps.poly[2*k - 2]
+            shapes_k = shapes_for_order(k, args.e)
+            SHAPES = SHAPES + shapes_k
+            SHAPE_ORDERS = SHAPE_ORDERS + [k] * len(shapes_k)
 
-    name_of_game = GAME_NAMES[args.n - 1] if 1 <= args.n <= 6 else "Mono"
-    add_text = "with extended polyominos" if args.e else ""
+    SAMPLER = AliasSampler(shape_weights(SHAPE_ORDERS, args.weights))
 
-    e = args.n if args.e else 0
-    one = 1 if args.n == 1 else 0
-    m = -1 if args.m else 0
-    COLS = (3 * args.n) + e - 1 + one + m
-    ROWS = (5 * args.n) + e
+    name_of_game = GAME_NAMES[args.n - 1] if 1 <= args.n <= len(GAME_NAMES) else "Mono"
+    # a shape file is sized by its largest order only, -e and -m do not apply
+    extended, mixed = (False, False) if args.shapes else (args.e, args.m)
+    add_text = "with extended polyominos" if extended else ""
 
+    COLS, ROWS = board_dimensions(args.n, extended, mixed)
 
-# initialize game settings
-if args.n is None:
-    # show menu to select n, ext and mix
-    try:
-        selected_n, selected_ext, selected_mix, selected_music = curses.wrapper(
-            show_menu)
-        if selected_n is None:
-            exit(0)
-        args.n = selected_n
-        args.e = selected_ext
-        args.m = selected_mix
-        args.music = selected_music  # Store selected music
-    except curses.error as e:
-        print("Error running curses menu.")
-        print("Your terminal may not be supported.")
-        print(f"Curses error: {e}")
-        exit(1)
-else:
-    args.music = None  # No music selection when using command line args
 
-initialize_shapes_and_dimensions()
+def board_dimensions(n, ext=False, mix=False):
+    """Return (COLS, ROWS) of the board for n-block pieces."""
+    e = n if ext else 0
+    one = 1 if n == 1 else 0
+    m = -1 if mix else 0
+    return (3 * n) + e - 1 + one + m, (5 * n) + e
 
 
 def rotate_piece(piece):
@@ -508,6 +944,87 @@ def rotate_piece(piece):
     return [list(row) for row in zip(*piece[::-1])]
 
 
+def all_rotations(shape):
+    """Return the 4 clockwise rotations of a shape, starting with the shape itself."""
+    rotations = [shape]
+    for _ in range(3):
+        rotations.append(rotate_piece(rotations[-1]))
+    return rotations
+
+
+PREVIEW_BATCH = 16  # pieces generated at once when the preview queue runs low
+PIECE_COLOR_IDS = 12  # color ids given to shapes in turn, stored in the board cells
+
+
+class PieceGenerator:
+    """
+    Piece source for one game: a seeded RNG, optional shuffled bag and a
+    ring buffer of upcoming (shape, color id) pieces refilled in batches.
+    """
+
+    def __init__(self, shapes, sampler, seed=None, bag=False, preview=1, batch=PREVIEW_BATCH):
+        self.rng = random.Random(seed)
+        self.sampler = sampler
+        self.bag = bag
+        self.bag_left = []
+        # rotations are computed once per shape while filling the queue,
+        # spawning just indexes into this table
+        self.shapes = shapes
+        self.rotations = [None] * len(shapes)
+        self.depth = max(1, preview)
+        self.size = self.depth + max(1, batch)
+        self.queue = [None] * self.size
+        self.head = 0
+        self.count = 0
+        self.fill()
+
+    def draw_index(self):
+        """Pick the index of the next shape."""
+        if not self.bag:
+            return self.sampler.draw(self.rng)
+        if not self.bag_left:
+            self.bag_left = list(range(len(self.shapes)))
+            self.rng.shuffle(self.bag_left)
+        return self.bag_left.pop()
+
+    def fill(self):
+        """Top the ring buffer up to its full size."""
+        rng = self.rng
+        while self.count < self.size:
+            i = self.draw_index()
+            if self.rotations[i] is None:
+                self.rotations[i] = all_rotations(self.shapes[i])
+            shape = self.rotations[i][rng.randint(0, 3)]
+            self.queue[(self.head + self.count) % self.size] = (shape, 1 + i % PIECE_COLOR_IDS)
+            self.count += 1
+
+    def refill(self):
+        """Refill the queue in one batch once it is down to the preview depth."""
+        if self.count <= self.depth:
+            self.fill()
+
+    def pop(self):
+        """
+        Take the next (shape, color id) out of the queue. The game refills it
+        between frames, pop only fills it when that has not happened in time.
+        """
+        piece = self.queue[self.head]
+        self.queue[self.head] = None
+        self.head = (self.head + 1) % self.size
+        self.count -= 1
+        if self.count < self.depth:
+            self.fill()
+        return piece
+
+    def peek(self, i=0):
+        """Return the i-th upcoming (shape, color id) without removing it."""
+        return self.queue[(self.head + i) % self.size]
+
+    def preview(self):
+        """Return the upcoming pieces, as many as the preview depth."""
+        return [self.peek(i) for i in range(self.depth)]
+
+
 def check_collision(board, piece, offset):
     """
     Check if the piece at the given offset collides with the board
@@ -527,27 +1044,26 @@ def check_collision(board, piece, offset):
 
 
 def create_board():
-    # creates an empty game board
-    return [[0 for _ in range(COLS)] for _ in range(ROWS)]
+    # creates an empty game board, a row is a bytearray of color ids (0 is empty)
+    return [bytearray(COLS) for _ in range(ROWS)]
 
 
 def new_piece():
     """Returns a new random piece dictionary."""
-    global next_shape
-    shape = next_shape
-    next_shape = random.choice(SHAPES)
-    for _ in range(random.randint(0, 3)):
-        next_shape = rotate_piece(next_shape)
+    global next_shape, next_color
+    shape, piece_color = generator.pop()
+    next_shape, next_color = generator.peek()
 
     offset = 0
     if args.n < 4:
         # this makes the game *slightly* more interesting for smaller n
-        offset = random.randint(-1, 1)
+        offset = generator.rng.randint(-1, 1)
 
     return {
         "shape": shape,
         "x": COLS // 2 - len(shape[0]) // 2 + offset,
         "y": 0,
+        "color": piece_color,
     }
 
 
@@ -559,7 +1075,7 @@ def lock_piece(board, piece):
                 board_y = piece["y"] + y
                 board_x = piece["x"] + x
                 if 0 <= board_y < ROWS and 0 <= board_x < COLS:
-                    board[board_y][board_x] = 1
+                    board[board_y][board_x] = piece["color"]
     return board
 
 
@@ -569,7 +1085,7 @@ def clear_lines(board):
     lines_cleared = ROWS - len(new_board)
     # add new empty lines at the top for each cleared line
     for _ in range(lines_cleared):
-        new_board.insert(0, [0 for _ in range(COLS)])
+        new_board.insert(0, bytearray(COLS))
     return new_board, lines_cleared
 
 
@@ -611,6 +1127,8 @@ def calculate_score(lines_cleared, level, combo_count):
         4: 1200,  # tetris (4 lines)
         5: 4096,  # pentis (5 lines)
         6: 16384,  # hexis (6 lines)
+        7: 65536,  # heptis (7 lines)
+        8: 262144,  # octis (8 lines)
     }
 
     # get base score
@@ -629,6 +1147,7 @@ def calculate_score(lines_cleared, level, combo_count):
     return total_score
 
 
+@timed("ghost")
 def get_ghost_piece_position(board, piece):
     """Calculate where the piece would land if hard dropped."""
     ghost_y = piece["y"]
@@ -640,6 +1159,746 @@ def get_ghost_piece_position(board, piece):
     return ghost_y
 
 
+def column_heights(board):
+    """Return the height of the stack in every column of the board."""
+    rows = len(board)
+    heights = [0] * len(board[0])
+    for x in range(len(heights)):
+        for y in range(rows):
+            if board[y][x]:
+                heights[x] = rows - y
+                break
+    return heights
+
+
+def bottom_profile(shape):
+    """
+    Return how high the lowest block of every column sits above the bottom
+    of the shape, or None if a column has a gap that would leave a hole.
+    """
+    height = len(shape)
+    depths = []
+    for x in range(len(shape[0])):
+        filled = [y for y in range(height) if shape[y][x]]
+        if not filled or filled[-1] - filled[0] + 1 != len(filled):
+            return None
+        depths.append(height - 1 - filled[-1])
+    return depths
+
+
+class SkylineIndex:
+    """
+    Index from a skyline pattern, the column heights over a window relative
+    to its leftmost column, to the shape rotations that rest on exactly that
+    surface without leaving holes. Also keeps the distinct rotations of
+    every shape and finds the shape index of a rotated shape.
+    """
+
+    def __init__(self, shapes):
+        self.table = {}
+        self.widths = set()
+        self.rotations = []
+        self.shape_ids = {}
+        for i, shape in enumerate(shapes):
+            seen = set()
+            self.rotations.append([])
+            for r, rotated in enumerate(all_rotations(shape)):
+                key = tuple(map(tuple, rotated))
+                if key in seen:
+                    continue  # symmetric shape, this rotation is already indexed
+                seen.add(key)
+                self.rotations[i].append(rotated)
+                self.shape_ids[key] = i
+                depths = bottom_profile(rotated)
+                if depths is None:
+                    continue
+                pattern = tuple(d - depths[0] for d in depths)
+                self.table.setdefault(pattern, []).append(
+                    (i, r, rotated, depths[0]))
+                self.widths.add(len(depths))
+        self.widths = sorted(self.widths)
+
+    def lookup(self, heights, x, width):
+        """Return the (shape index, rotation, shape, depth) entries that fit heights[x:x+width]."""
+        base = heights[x]
+        return self.table.get(tuple(h - base for h in heights[x:x + width]), ())
+
+    def shape_index(self, shape):
+        """Return the index of the shape a rotated shape belongs to, or None."""
+        return self.shape_ids.get(tuple(map(tuple, shape)))
+
+    def placements(self, board, only=None):
+        """
+        Return (shape index, rotation, shape, x, y) for every hole free
+        resting position on the current surface of the board, of shape
+        index only if given.
+        """
+        rows = len(board)
+        heights = column_heights(board)
+        found = []
+        for width in self.widths:
+            for x in range(len(heights) - width + 1):
+                for i, r, shape, depth in self.lookup(heights, x, width):
+                    if only is not None and i != only:
+                        continue
+                    y = rows - heights[x] - len(shape) + depth
+                    # overhangs above the surface can still be in the way
+                    if y >= 0 and not check_collision(board, shape, (x, y)):
+                        found.append((i, r, shape, x, y))
+        return found
+
+
+class FrameBuffer:
+    """
+    Off-screen character/attribute grid with the part of the stdscr interface
+    the draw functions use. A frame is drawn into it and a renderer sends
+    only the cells that differ from the previous frame to the terminal.
+    """
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.chars = [[" "] * width for _ in range(height)]
+        self.attrs = [[0] * width for _ in range(height)]
+        # rows written since the last present, only those are compared
+        self.dirty = set(range(height))
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def addstr(self, y, x, text, attr=0):
+        # like curses, write what fits and raise curses.error for the rest
+        if not 0 <= y < self.height or not 0 <= x < self.width:
+            raise curses.error("addstr() returned ERR")
+        end = min(self.width, x + len(text))
+        self.chars[y][x:end] = text[:end - x]
+        self.attrs[y][x:end] = [attr] * (end - x)
+        self.dirty.add(y)
+        if end - x < len(text):
+            raise curses.error("addstr() returned ERR")
+
+    def erase_region(self, y, x, height, width):
+        """Blank a rectangle of the frame, clipped to its size."""
+        x_end = min(self.width, x + width)
+        if x_end <= x:
+            return
+        for row in range(max(0, y), min(self.height, y + height)):
+            self.chars[row][x:x_end] = [" "] * (x_end - x)
+            self.attrs[row][x:x_end] = [0] * (x_end - x)
+            self.dirty.add(row)
+
+    def erase(self):
+        self.erase_region(0, 0, self.height, self.width)
+
+    clear = erase
+
+
+class Renderer:
+    """
+    Base class of the game renderers. The game draws into self.frame and
+    calls present(), which finds the changed span of every changed row and
+    hands it to write_runs() of the backend, then flush().
+    """
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.bytes_written = 0
+        self.flush_time = 0.0
+        self.resize()
+
+    def resize(self):
+        height, width = self.stdscr.getmaxyx()
+        self.frame = FrameBuffer(height, width)
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget what is on the screen, the next present repaints everything."""
+        self.shown_chars = [None] * self.frame.height
+        self.shown_attrs = [None] * self.frame.height
+        self.frame.dirty.update(range(self.frame.height))
+        # what each screen region was last drawn with, see region_changed
+        self.regions = {}
+
+    def region_changed(self, name, state):
+        """Return True if region name has to be redrawn to show state."""
+        if name in self.regions and self.regions[name] == state:
+            return False
+        self.regions[name] = state
+        return True
+
+    def present(self):
+        """Send the differences between the frame and the screen to the terminal."""
+        frame = self.frame
+        dirty = frame.dirty
+        frame.dirty = set()
+        for y in sorted(dirty):
+            chars, attrs = frame.chars[y], frame.attrs[y]
+            shown_chars, shown_attrs = self.shown_chars[y], self.shown_attrs[y]
+            if chars == shown_chars and attrs == shown_attrs:
+                continue
+
+            # narrow the write down to the changed span of the row
+            start, end = 0, frame.width
+            if shown_chars is not None:
+                while chars[start] == shown_chars[start] and attrs[start] == shown_attrs[start]:
+                    start += 1
+                while chars[end - 1] == shown_chars[end - 1] and attrs[end - 1] == shown_attrs[end - 1]:
+                    end -= 1
+            self.write_runs(y, start, end, chars, attrs)
+            self.shown_chars[y] = chars[:]
+            self.shown_attrs[y] = attrs[:]
+
+        start = time.perf_counter()
+        self.flush()
+        self.flush_time = time.perf_counter() - start
+
+    def write_runs(self, y, start, end, chars, attrs):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class CursesRenderer(Renderer):
+    """Differential renderer writing through curses, composited with doupdate."""
+
+    def invalidate(self):
+        super().invalidate()
+        self.stdscr.erase()
+
+    def write_runs(self, y, start, end, chars, attrs):
+        """Write chars[start:end] with one addstr per run of equal attributes."""
+        x = start
+        while x < end:
+            attr = attrs[x]
+            run_end = x + 1
+            while run_end < end and attrs[run_end] == attr:
+                run_end += 1
+            text = "".join(chars[x:run_end])
+            try:
+                self.stdscr.addstr(y, x, text, attr)
+            except curses.error:
+                pass  # writing the bottom right cell always errors
+            # curses does not report what it sends, estimate text + cursor move
+            self.bytes_written += len(text.encode()) + 8
+            x = run_end
+
+    def flush(self):
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+
+class AnsiRenderer(Renderer):
+    """
+    Differential renderer that bypasses curses output: the whole frame diff
+    is built as cursor movement and 256 color SGR escapes in one buffer and
+    sent with a single os.write. curses is still used for input.
+    """
+
+    def __init__(self, stdscr, fd=None):
+        self.fd = sys.stdout.fileno() if fd is None else fd
+        self.out = []
+        self.sgr_cache = {}
+        super().__init__(stdscr)
+
+    def invalidate(self):
+        super().invalidate()
+        # colors may have changed, and curses must agree the screen is blank
+        self.sgr_cache = {}
+        self.attr = None
+        self.cursor = None
+        self.stdscr.erase()
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+    def sgr(self, attr):
+        """Return the escape sequence selecting the colors and style of attr."""
+        code = self.sgr_cache.get(attr)
+        if code is None:
+            if not attr & curses.A_COLOR:
+                # uncolored text takes the window background, like in curses
+                attr |= self.stdscr.getbkgd() & ~curses.A_CHARTEXT
+            fg, bg = curses.pair_content(curses.pair_number(attr))
+            params = ["0"]
+            if attr & curses.A_BOLD:
+                params.append("1")
+            if attr & curses.A_BLINK:
+                params.append("5")
+            if attr & curses.A_REVERSE:
+                params.append("7")
+            params.append(f"38;5;{fg}" if fg >= 0 else "39")
+            params.append(f"48;5;{bg}" if bg >= 0 else "49")
+            code = f"\x1b[{';'.join(params)}m"
+            self.sgr_cache[attr] = code
+        return code
+
+    def write_runs(self, y, start, end, chars, attrs):
+        out = self.out
+        if self.cursor != (y, start):
+            out.append(f"\x1b[{y + 1};{start + 1}H")
+
+        # blank tail of the row is cleared with one erase to end of line
+        clear_to_eol = False
+        if end == self.frame.width:
+            tail = end
+            while tail > start and chars[tail - 1] == " " and attrs[tail - 1] == attrs[end - 1]:
+                tail -= 1
+            if end - tail > 3:
+                end, clear_to_eol = tail, True
+
+        for x in range(start, end):
+            if attrs[x] != self.attr:
+                self.attr = attrs[x]
+                out.append(self.sgr(self.attr))
+            out.append(chars[x])
+        if clear_to_eol:
+            if attrs[-1] != self.attr:
+                self.attr = attrs[-1]
+                out.append(self.sgr(self.attr))
+            out.append("\x1b[K")
+        self.cursor = (y, end)
+
+    def flush(self):
+        if not self.out:
+            return
+        data = memoryview("".join(self.out).encode())
+        self.out = []
+        self.bytes_written += len(data)
+        while data:
+            data = data[os.write(self.fd, data):]
+
+
+COALESCE_BACKLOG = 2048  # bytes waiting for the terminal before frames are skipped
+COALESCE_BUDGET = 0.010  # seconds a flush may take before the next frames are skipped
+COALESCE_MAX_SKIP = 10  # frames skipped at most after one slow flush
+
+
+class FrameCoalescer:
+    """
+    Frame skipping for slow terminals (--adaptive). A frame is skipped while
+    the terminal output queue still holds more than COALESCE_BACKLOG bytes,
+    or after a flush that took longer than COALESCE_BUDGET, so only the
+    newest state is drawn once the link catches up. Also measures the output
+    rate in bytes per second.
+    """
+
+    def __init__(self, renderer, fd=None):
+        self.renderer = renderer
+        self.fd = sys.stdout.fileno() if fd is None else fd
+        self.skip = 0
+        self.skipped = 0
+        self.rate = 0
+        self.rate_start = time.monotonic()
+        self.rate_bytes = renderer.bytes_written
+
+    def backlog(self):
+        """Bytes written to the terminal that it has not consumed yet."""
+        try:
+            queued = fcntl.ioctl(self.fd, termios.TIOCOUTQ, struct.pack("i", 0))
+            return struct.unpack("i", queued)[0]
+        except (OSError, AttributeError):
+            return 0
+
+    def ready(self):
+        """Return True if this frame should be drawn."""
+        if self.skip > 0 or self.backlog() > COALESCE_BACKLOG:
+            self.skip = max(0, self.skip - 1)
+            self.skipped += 1
+            return False
+        return True
+
+    def drawn(self):
+        """Account for a frame that was just presented."""
+        flush_time = self.renderer.flush_time
+        if flush_time > COALESCE_BUDGET:
+            self.skip = min(COALESCE_MAX_SKIP, int(flush_time / COALESCE_BUDGET))
+
+        now = time.monotonic()
+        if now - self.rate_start >= 1.0:
+            written = self.renderer.bytes_written
+            self.rate = int((written - self.rate_bytes) / (now - self.rate_start))
+            self.rate_start, self.rate_bytes = now, written
+
+
+TICK_RATE = 50  # game logic ticks per second, like PAL
+MAX_CATCH_UP = 5  # ticks run at most after a slow frame, older lag is dropped
+
+
+class GameClock:
+    """
+    Fixed timestep clock on time.monotonic_ns. Logic ticks run at exactly
+    tick_rate per second, catching up after slow frames by at most
+    MAX_CATCH_UP ticks, and frames are due at frame_rate per second at
+    most. The game sleeps through ticks where nothing happens, so the
+    catch-up bound counts from the tick it planned to wake up at.
+    """
+
+    def __init__(self, tick_rate=TICK_RATE, frame_rate=60):
+        self.tick_ns = 1_000_000_000 // tick_rate
+        self.frame_ns = 1_000_000_000 // frame_rate
+        self.reset()
+
+    def reset(self):
+        """Start counting from now, after a pause or anything else that blocks."""
+        now = time.monotonic_ns()
+        self.next_tick = now + self.tick_ns
+        self.next_frame = now
+        self.planned = 1
+
+    def ticks(self):
+        """Number of logic ticks due since the last call."""
+        now = time.monotonic_ns()
+        if now < self.next_tick:
+            return 0
+        due = (now - self.next_tick) // self.tick_ns + 1
+        limit = self.planned + MAX_CATCH_UP - 1
+        if due > limit:
+            due = limit
+            self.next_tick = now + self.tick_ns
+        else:
+            self.next_tick += due * self.tick_ns
+        return due
+
+    def frame_due(self):
+        """Return True if a frame should be drawn now."""
+        now = time.monotonic_ns()
+        if now < self.next_frame:
+            return False
+        self.next_frame += self.frame_ns
+        if self.next_frame <= now:
+            self.next_frame = now + self.frame_ns
+        return True
+
+    def timeout(self, ticks_ahead=1, frame=True):
+        """
+        Milliseconds for getch to wait until ticks_ahead ticks are due, or
+        until the next frame if there is a frame to draw.
+        """
+        self.planned = max(1, ticks_ahead)
+        deadline = self.next_tick + (self.planned - 1) * self.tick_ns
+        if frame:
+            deadline = min(deadline, self.next_frame)
+        wait = deadline - time.monotonic_ns()
+        return max(0, -(-wait // 1_000_000))
+
+
+GC_PLAY_THRESHOLDS = (20000, 50, 1000)  # young collections rare, full ones almost never during play
+
+
+@contextlib.contextmanager
+def tuned_gc():
+    """
+    Keep the collector out of the frames while a game runs: everything
+    allocated so far (shape tables, curses setup) is frozen out of future
+    collections and the thresholds are raised. Pause and game over collect
+    explicitly through gc_safe_point.
+    """
+    thresholds = gc.get_threshold()
+    gc.collect()
+    gc.freeze()
+    gc.set_threshold(*GC_PLAY_THRESHOLDS)
+    try:
+        yield
+    finally:
+        gc.set_threshold(*thresholds)
+        gc.unfreeze()
+
+
+def gc_safe_point():
+    """Collect now, while the player is not waiting for a frame."""
+    gc.collect()
+
+
+HISTOGRAM_BUCKETS = 14  # powers of two from 1/16 ms to 512 ms and up
+HISTOGRAM_SAMPLES = 1000  # recent samples kept for percentiles
+
+
+class FrameHistogram:
+    """Frame times in power-of-two buckets, with percentiles of the recent ones."""
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.recent = collections.deque(maxlen=HISTOGRAM_SAMPLES)
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        bucket = 0 if ms <= 1 / 16 else min(HISTOGRAM_BUCKETS - 1, int(log2(ms * 16)) + 1)
+        self.counts[bucket] += 1
+        self.recent.append(ms)
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """p-th percentile of the recent frames in milliseconds."""
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def summary(self):
+        return f"p50 {self.percentile(50):.2f} ms, p99 {self.percentile(99):.2f} ms, max {self.max:.2f} ms"
+
+    def lines(self, width=40):
+        """The histogram as text, one line per bucket from the first to the last used one."""
+        used = [i for i, count in enumerate(self.counts) if count]
+        if not used:
+            return []
+        top = max(self.counts)
+        lines = []
+        for i in range(used[0], used[-1] + 1):
+            bound = f"<= {2 ** i / 16:g} ms" if i < HISTOGRAM_BUCKETS - 1 else f"> {2 ** (i - 1) / 16:g} ms"
+            bar = "█" * round(width * self.counts[i] / top)
+            lines.append(f"{bound:>12} {bar} {self.counts[i]}")
+        return lines
+
+
+STATS_PHASES = ("input", "logic", "ghost", "render", "sound")
+STATS_REFRESH = 0.5  # seconds between updates of the overlay
+STATS_WIDTH = 30
+
+
+class PhaseStats:
+    """
+    Time spent per drawn frame in each phase (--stats). Phases nest, a
+    phase's time excludes the phases timed inside it, so sound played
+    during the logic counts as sound only.
+    """
+
+    def __init__(self):
+        self.phases = {name: FrameHistogram() for name in STATS_PHASES}
+        self.frame = dict.fromkeys(STATS_PHASES, 0.0)
+        self.stack = []  # [phase, start, time of nested phases]
+        self.version = 0
+        self.shown = time.perf_counter()
+
+    def begin(self, phase):
+        self.stack.append([phase, time.perf_counter(), 0.0])
+
+    def end(self):
+        phase, start, nested = self.stack.pop()
+        spent = time.perf_counter() - start
+        self.frame[phase] += spent - nested
+        if self.stack:
+            self.stack[-1][2] += spent
+
+    def skip_frame(self):
+        """Forget the time of the frame so far, such as the time spent paused."""
+        now = time.perf_counter()
+        for entry in self.stack:
+            entry[1] = now
+            entry[2] = 0.0
+        self.frame = dict.fromkeys(STATS_PHASES, 0.0)
+
+    def end_frame(self):
+        """Record the phases of the frame just drawn, everything since the last one."""
+        for name, spent in self.frame.items():
+            self.phases[name].add(spent)
+            self.frame[name] = 0.0
+        now = time.perf_counter()
+        if now - self.shown >= STATS_REFRESH:
+            self.version += 1
+            self.shown = now
+
+    def lines(self):
+        lines = [f"{'ms/frame':<8}{'p50':>7}{'p99':>7}{'max':>8}"]
+        for name, times in self.phases.items():
+            lines.append(f"{name:<8}{times.percentile(50):>7.2f}{times.percentile(99):>7.2f}{times.max:>8.2f}")
+        if quality:
+            lines.append(f"{'degraded':<8}{quality.degraded:>14} lvl {quality.level}")
+        return lines
+
+    def report(self):
+        """Histograms of all phases, printed on exit."""
+        lines = []
+        for name, times in self.phases.items():
+            lines.append(f"{name}: {times.summary()}")
+            lines += times.lines()
+        if quality:
+            lines.append(f"degraded frames: {quality.degraded}")
+        return "\n".join(lines)
+
+
+stats = PhaseStats() if args.stats else None
+STATS_LINES = len(STATS_PHASES) + 2
+QUALITY_RECOVER_FRAMES = 30  # frames well under budget before a dropped feature comes back
+
+
+class QualityGovernor:
+    """
+    Drops features in the --degrade order while frames overrun the
+    --frame-budget, one more for every frame over budget, and brings them
+    back after QUALITY_RECOVER_FRAMES frames under half the budget. Input
+    and gravity are never dropped. Counts the frames drawn degraded.
+    """
+
+    def __init__(self, budget, order):
+        self.budget = budget
+        self.order = order
+        self.level = 0
+        self.calm = 0
+        self.degraded = 0
+
+    def skips(self, feature):
+        return feature in self.order[:self.level]
+
+    def frame_done(self, seconds):
+        """Account for a drawn frame that took seconds of work."""
+        if self.level:
+            self.degraded += 1
+        if seconds > self.budget:
+            self.level = min(len(self.order), self.level + 1)
+            self.calm = 0
+        elif seconds < self.budget / 2 and self.level:
+            self.calm += 1
+            if self.calm >= QUALITY_RECOVER_FRAMES:
+                self.level -= 1
+                self.calm = 0
+        else:
+            self.calm = 0
+
+
+def draw_stats(stdscr):
+    """Draw the --stats overlay where the layout has room for it."""
+    y, x = layout.stats_pos
+    stdscr.erase_region(y, x, STATS_LINES, STATS_WIDTH)
+    try:
+        for i, line in enumerate(stats.lines()):
+            stdscr.addstr(y + i, x, line)
+    except curses.error:
+        pass
+
+
+RENDERERS = {
+    "curses": CursesRenderer,
+    "ansi": AnsiRenderer,
+}
+
+
+class NullScreen:
+    """
+    Stand-in for stdscr that needs no terminal and discards all output.
+    getch returns the scripted keys in order, then end_key.
+    """
+
+    def __init__(self, height=50, width=120, keys=(), end_key=-1):
+        self.height = height
+        self.width = width
+        self.keys = list(keys)
+        self.end_key = end_key
+        self.background = ord(" ")
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def addstr(self, y, x, text, attr=0):
+        if not 0 <= y < self.height or not 0 <= x < self.width:
+            raise curses.error("addstr() returned ERR")
+
+    def getch(self):
+        return self.keys.pop(0) if self.keys else self.end_key
+
+    def bkgd(self, ch, attr=0):
+        self.background = ord(ch) | attr
+
+    def getbkgd(self):
+        return self.background
+
+    def erase(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def noutrefresh(self):
+        pass
+
+    def nodelay(self, flag):
+        pass
+
+    def timeout(self, delay):
+        pass
+
+    def keypad(self, flag):
+        pass
+
+
+class RecordingScreen(NullScreen):
+    """
+    NullScreen that keeps what was drawn in a character/attribute grid and
+    counts the calls made to every method.
+    """
+
+    def __init__(self, height=50, width=120, keys=(), end_key=-1):
+        super().__init__(height, width, keys, end_key)
+        self.grid = FrameBuffer(height, width)
+        self.calls = {}
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def addstr(self, y, x, text, attr=0):
+        self.count("addstr")
+        self.grid.addstr(y, x, text, attr)
+
+    def getch(self):
+        self.count("getch")
+        return super().getch()
+
+    def erase(self):
+        self.count("erase")
+        self.grid.erase()
+
+    def clear(self):
+        self.count("clear")
+        self.grid.erase()
+
+    def refresh(self):
+        self.count("refresh")
+
+    def noutrefresh(self):
+        self.count("noutrefresh")
+
+    def lines(self):
+        """Return the recorded screen as a list of strings."""
+        return ["".join(row) for row in self.grid.chars]
+
+
+@contextlib.contextmanager
+def headless_curses(colors=256):
+    """
+    Replace the module level curses calls the game makes (colors, cursor,
+    doupdate) with in-process versions, so the draw functions can run on a
+    NullScreen or RecordingScreen without initscr.
+    """
+    pairs = {0: (-1, -1)}
+    missing = object()
+    stand_ins = {
+        "start_color": lambda: None,
+        "init_pair": lambda pair, fg, bg: pairs.__setitem__(pair, (fg, bg)),
+        "pair_content": lambda pair: pairs.get(pair, (-1, -1)),
+        "color_pair": lambda pair: pair << 8,
+        "pair_number": lambda attr: (attr & curses.A_COLOR) >> 8,
+        "curs_set": lambda visibility: 1,
+        "doupdate": lambda: None,
+        "COLORS": colors,
+        "COLOR_PAIRS": 256,
+    }
+    saved = {name: getattr(curses, name, missing) for name in stand_ins}
+    for name, value in stand_ins.items():
+        setattr(curses, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is missing:
+                delattr(curses, name)
+            else:
+                setattr(curses, name, value)
+
+
 def draw_progress_bar(stdscr, y, x, width, current, target, label=""):
     """Draw a progress bar showing current/target with visual indicator."""
     if target == 0:
@@ -657,18 +1916,91 @@ def draw_progress_bar(stdscr, y, x, width, current, target, label=""):
         pass
 
 
+PANEL_WIDTH = 34  # the widest line of the side panel is the progress bar
+GHOST_CELL = 255  # marks ghost cells in rows drawn one character per cell
+THUMB_WIDTH = 8  # inside of the next and hold boxes
+THUMB_HEIGHT = 5
+
+
+class Layout:
+    """
+    Positions on the game screen, computed once per terminal size. When the
+    terminal is too small for the full layout the board is drawn with one
+    character per cell, and with two board rows per line if it is too low.
+    """
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.half_rows = height < ROWS + 3
+        self.compact = self.half_rows or width < COLS * 2 + 3 + PANEL_WIDTH
+        self.cell_width = 1 if self.compact else 2
+        self.board_rows = (ROWS + 1) // 2 if self.half_rows else ROWS
+        self.board_top = 2
+        self.board_left = 1
+        self.board_width = COLS * self.cell_width
+        self.panel_x = self.board_width + 3
+        self.info_y = THUMB_HEIGHT + 3
+        # the side panel is left out when it does not fit next to the board
+        self.panel = self.panel_x + PANEL_WIDTH <= width and self.info_y + 4 <= height
+        self.fits = width >= self.board_width + 2 and height >= self.board_rows + 3
+        # the --stats overlay goes below the board, or right of the panel
+        self.stats_pos = None
+        if self.board_rows + 3 + STATS_LINES <= height:
+            self.stats_pos = (self.board_rows + 3, 0)
+        elif self.panel and self.panel_x + PANEL_WIDTH + STATS_WIDTH <= width:
+            self.stats_pos = (2, self.panel_x + PANEL_WIDTH)
+
+
+layout = None
+
+
+def update_layout(stdscr):
+    """Recompute the layout for the current terminal size."""
+    global layout
+    layout = Layout(*stdscr.getmaxyx())
+
+
+thumbnails = {}
+
+
+def thumbnail(shape):
+    """
+    Rows of text showing shape inside a preview box, rendered once per
+    shape rotation. Cells are two characters wide when the shape fits,
+    then one, then two rows share a line of half blocks.
+    """
+    key = tuple(map(tuple, shape))
+    rows = thumbnails.get(key)
+    if rows is None:
+        height, width = len(shape), len(shape[0])
+        if width * 2 <= THUMB_WIDTH and height <= THUMB_HEIGHT:
+            rows = ["".join(BLOCK_CHAR * 2 if cell else "  " for cell in row) for row in shape]
+        elif width <= THUMB_WIDTH and height <= THUMB_HEIGHT:
+            rows = ["".join(BLOCK_CHAR if cell else " " for cell in row) for row in shape]
+        else:
+            padded = list(shape) + [[0] * width] * (height % 2)
+            rows = ["".join(" ▀▄█"[bool(a) + 2 * bool(b)] for a, b in zip(top, bottom))
+                    for top, bottom in zip(padded[::2], padded[1::2])]
+        thumbnails[key] = rows
+    return rows
+
+
+def draw_thumbnail(stdscr, start_y, start_x, shape, piece_color):
+    """Draw the thumbnail of shape centered inside the box at the position."""
+    rows = thumbnail(shape)
+    y = start_y + 1 + (THUMB_HEIGHT - len(rows)) // 2
+    x = start_x + 1 + (THUMB_WIDTH - len(rows[0])) // 2
+    for i, row in enumerate(rows):
+        stdscr.addstr(y + i, x, row, cell_attr(piece_color))
+
+
 def draw_hold_piece(stdscr, start_y, start_x):
     """Draw the held piece in a designated area."""
-    global held_shape
-
     try:
-        stdscr.addstr(start_y, start_x, "HOLD:")
+        draw_preview_box(stdscr, start_y, start_x, "HOLD")
         if held_shape:
-            for y, row in enumerate(held_shape):
-                for x, cell in enumerate(row):
-                    if cell:
-                        stdscr.addstr(start_y + 1 + y, start_x +
-                                      x * 2, BLOCK_CHAR * 2)
+            draw_thumbnail(stdscr, start_y, start_x, held_shape, held_color)
     except curses.error:
         pass
 
@@ -680,25 +2012,32 @@ def draw_game_info(stdscr, score):
     try:
         # main title with decorative elements
         title = f"Score: {score} | Playing {name_of_game}is {add_text}"
-        stdscr.addstr(0, 0, title)
+        stdscr.addstr(0, 0, title[:layout.width - 1])
+
+        x, y = layout.panel_x, layout.info_y
+        if not layout.panel:
+            return y + 4
 
         # level information
-        stdscr.addstr(args.n + 2, 3+COLS*2, f"Level: {level}")
+        stdscr.addstr(y, x, f"Level: {level}")
 
         # progress bar
-        draw_progress_bar(stdscr, args.n + 3, 3+COLS*2, 15,
+        draw_progress_bar(stdscr, y + 1, x, 15,
                           total_lines, 5+level, "Progress: ")
 
         # combo display
         if combo_count > 0:
-            stdscr.addstr(args.n + 4, 3+COLS*2, f"COMBO: {combo_count}x")
-            stdscr.addstr(args.n + 5, 3+COLS*2, f"Colors: {color}/{bcgd}")
-            return args.n + 7
-        else:
-            stdscr.addstr(args.n + 4, 3+COLS*2, f"Colors: {color}/{bcgd}")
-            return args.n + 6
+            stdscr.addstr(y + 2, x, f"COMBO: {combo_count}x")
+            y += 1
+        stdscr.addstr(y + 2, x, f"Colors: {color}/{bcgd}")
+
+        # output rate of the adaptive mode
+        if coalescer:
+            stdscr.addstr(y + 3, x, f"Output: {coalescer.rate} B/s, {coalescer.skipped} skipped")
+            y += 1
+        return y + 4
     except curses.error:
-        return args.n + 6
+        return layout.info_y + 4
 
 
 def draw_border(stdscr):
@@ -706,99 +2045,240 @@ def draw_border(stdscr):
     try:
         # top border
         top_border = CORNER_CHAR[0] + \
-            TOP_BOTTOM_BORDER_CHAR * (COLS * 2) + CORNER_CHAR[1]
+            TOP_BOTTOM_BORDER_CHAR * layout.board_width + CORNER_CHAR[1]
         stdscr.addstr(1, 0, top_border)
 
         # side borders
-        for y in range(ROWS):
+        for y in range(layout.board_rows):
             stdscr.addstr(y + 2, 0, BORDER_CHAR)
-            stdscr.addstr(y + 2, COLS * 2 + 1, BORDER_CHAR)
+            stdscr.addstr(y + 2, layout.board_width + 1, BORDER_CHAR)
 
         # bottom border
         bottom_border = CORNER_CHAR[2] + \
-            TOP_BOTTOM_BORDER_CHAR * (COLS * 2) + CORNER_CHAR[3]
-        stdscr.addstr(ROWS + 2, 0, bottom_border)
+            TOP_BOTTOM_BORDER_CHAR * layout.board_width + CORNER_CHAR[3]
+        stdscr.addstr(layout.board_rows + 2, 0, bottom_border)
     except curses.error:
         pass
 
 
-def draw_next_piece_box(stdscr):
-    """Draw a decorative box for the next piece."""
-    start_x = 3 + COLS * 2
-    start_y = 1
-
+def draw_preview_box(stdscr, start_y, start_x, title="NEXT"):
+    """Draw a decorative box for the next or the held piece."""
     # box border
-    stdscr.addstr(start_y, start_x, "┌─ NEXT ─┐")
-    for i in range(1, 6):
-        stdscr.addstr(start_y + i, start_x, "│        │")
-    stdscr.addstr(start_y + 6, start_x, "└────────┘")
+    stdscr.addstr(start_y, start_x, f"┌─ {title} ─┐")
+    for i in range(1, THUMB_HEIGHT + 1):
+        stdscr.addstr(start_y + i, start_x, "│" + " " * THUMB_WIDTH + "│")
+    stdscr.addstr(start_y + THUMB_HEIGHT + 1, start_x, "└" + "─" * THUMB_WIDTH + "┘")
 
 
-def draw_game(stdscr, board, piece, score):
-    """Draws the enhanced game state to the screen."""
-    stdscr.clear()
+ROW_CACHE_SIZE = 4096  # rendered rows kept before the cache starts over
+row_runs = {}
 
-    # draw enhanced game info and get hold position
-    hold_y = draw_game_info(stdscr, score)
 
-    # draw enhanced border
-    draw_border(stdscr)
+def board_row_runs(row, width=2):
+    """
+    Return the runs of a board row as (x, text, color id) for cells of width
+    characters, cached by the row contents.
+    """
+    key = (bytes(row), width)
+    runs = row_runs.get(key)
+    if runs is None:
+        if len(row_runs) >= ROW_CACHE_SIZE:
+            row_runs.clear()
+        runs = []
+        x = 0
+        while x < len(row):
+            cell = row[x]
+            end = x + 1
+            while end < len(row) and row[end] == cell:
+                end += 1
+            char = " " if not cell else "░" if cell == GHOST_CELL else BLOCK_CHAR
+            runs.append((x, char * (width * (end - x)), cell))
+            x = end
+        row_runs[key] = runs
+    return runs
+
+
+PIECE_PALETTE = [196, 46, 226, 33, 201, 51, 208, 129, 118, 39, 214, 165]
+PIECE_PALETTE_BASIC = [curses.COLOR_RED, curses.COLOR_GREEN, curses.COLOR_YELLOW,
+                       curses.COLOR_BLUE, curses.COLOR_MAGENTA, curses.COLOR_CYAN]
+
+
+class ColorPairAllocator:
+    """
+    Hands out curses color pairs for (foreground, background) combinations
+    from a fixed range, reusing the least recently used pair once all are
+    taken. evicted is set when a pair shown on screen got a new meaning.
+    """
 
-    # draw the board with locked pieces
-    for y, row in enumerate(board):
-        for x, cell in enumerate(row):
-            if cell:
-                try:
-                    stdscr.addstr(y + 2, x * 2 + 1, BLOCK_CHAR * 2)
-                except curses.error:
-                    pass
+    def __init__(self, first, last):
+        self.free = list(range(last, first - 1, -1))
+        self.pairs = collections.OrderedDict()
+        self.evicted = False
+
+    def get(self, fg, bg):
+        key = (fg, bg)
+        pair = self.pairs.get(key)
+        if pair is not None:
+            self.pairs.move_to_end(key)
+            return pair
+        if self.free:
+            pair = self.free.pop()
+        else:
+            _, pair = self.pairs.popitem(last=False)
+            self.evicted = True
+        curses.init_pair(pair, fg, bg)
+        self.pairs[key] = pair
+        return pair
+
+
+def init_color_pairs():
+    """Create the allocator for piece colors, pairs below 16 belong to the menus."""
+    global color_pairs
+    color_pairs = ColorPairAllocator(16, min(curses.COLOR_PAIRS, 256) - 1)
+
+
+def cell_attr(cell):
+    """Curses attribute of a board cell holding color id cell."""
+    if not args.piece_colors or color_pairs is None or not cell or cell == GHOST_CELL:
+        return 0
+    palette = PIECE_PALETTE if curses.COLORS >= 256 else PIECE_PALETTE_BASIC
+    fg = palette[(cell - 1) % len(palette)]
+    return curses.color_pair(color_pairs.get(fg, bcgd)) | curses.A_BOLD
+
+
+tile_strings = {}
 
-    # draw ghost piece (where current piece will land)
-    if piece:
-        ghost_y = get_ghost_piece_position(board, piece)
-        # only draw ghost if it's different from current position
-        if ghost_y != piece["y"]:
-            for y, row in enumerate(piece["shape"]):
-                for x, cell in enumerate(row):
-                    if not cell:
-                        continue
-                    ghost_board_y = ghost_y + y
-                    ghost_board_x = piece["x"] + x
-                    # check bounds and if position is empty
-                    if (0 <= ghost_board_y < ROWS and 0 <= ghost_board_x < COLS and
-                            not board[ghost_board_y][ghost_board_x]):
-                        try:
-                            stdscr.addstr(ghost_board_y + 2,
-                                          ghost_board_x * 2 + 1, "░░")
-                        except curses.error:
-                            pass
 
-    # draw the current falling piece
+def tile_row_string(top, bottom=None):
+    """
+    Text of a board row at one character per cell, used by the compact
+    layout and the spectator view; with bottom given two board rows share
+    a line of half-block characters.
+    """
+    key = (bytes(top), None if bottom is None else bytes(bottom))
+    text = tile_strings.get(key)
+    if text is None:
+        if len(tile_strings) >= ROW_CACHE_SIZE:
+            tile_strings.clear()
+        if bottom is None:
+            text = "".join("░" if cell == GHOST_CELL else BLOCK_CHAR if cell else " "
+                           for cell in top)
+        else:
+            # half blocks have no room for the ghost
+            text = "".join(" ▀▄█"[(0 < a < GHOST_CELL) + 2 * (0 < b < GHOST_CELL)]
+                           for a, b in zip(top, bottom))
+        tile_strings[key] = text
+    return text
+
+
+def overlay_piece(rows, shape, off_x, off_y, value):
+    """
+    Write value into the cells of shape at the offset, copying only the rows
+    it touches, so the board itself is left alone. Ghost cells only go into
+    empty cells.
+    """
+    for y, shape_row in enumerate(shape):
+        board_y = off_y + y
+        if not 0 <= board_y < len(rows) or not any(shape_row):
+            continue
+        merged = bytearray(rows[board_y])
+        for x, cell in enumerate(shape_row):
+            if cell and 0 <= off_x + x < len(merged):
+                if value != GHOST_CELL or not merged[off_x + x]:
+                    merged[off_x + x] = value
+        rows[board_y] = merged
+    return rows
+
+
+def draw_board(stdscr, board, piece):
+    """
+    Draw the board with the ghost and the falling piece merged into copies
+    of the rows they touch. Every row goes out as one addstr per run of
+    cells with the same color, or as half-block text in the lowest layout.
+    """
+    rows = list(board)
     if piece:
-        for y, row in enumerate(piece["shape"]):
-            for x, cell in enumerate(row):
-                if cell:
-                    if piece["y"] + y >= 0:
-                        try:
-                            stdscr.addstr(
-                                piece["y"] + y + 2, (piece["x"] + x) * 2 + 1, BLOCK_CHAR * 2)
-                        except curses.error:
-                            pass
+        if not layout.half_rows and not (quality and quality.skips("ghost")):
+            ghost_y = get_ghost_piece_position(board, piece)
+            overlay_piece(rows, piece["shape"], piece["x"], ghost_y, GHOST_CELL)
+        overlay_piece(rows, piece["shape"], piece["x"], piece["y"], piece["color"])
 
-    # draw next piece
+    top, left, width = layout.board_top, layout.board_left, layout.cell_width
     try:
-        stdscr.addstr(1, 3+COLS*2, "NEXT:")
-        for y, row in enumerate(next_shape):
-            for x, cell in enumerate(row):
-                if cell:
-                    stdscr.addstr(y + 2, 3+COLS*2 + (x * 2), BLOCK_CHAR * 2)
+        if layout.half_rows:
+            blank = bytes(COLS)
+            for y in range(layout.board_rows):
+                bottom = rows[2*y + 1] if 2*y + 1 < ROWS else blank
+                stdscr.addstr(top + y, left, tile_row_string(rows[2*y], bottom))
+            return
+
+        for y, row in enumerate(rows):
+            for x, text, cell in board_row_runs(row, width):
+                stdscr.addstr(top + y, left + x * width, text, cell_attr(cell))
     except curses.error:
         pass
 
-    # draw held piece
-    draw_hold_piece(stdscr, hold_y, 3+COLS*2)
 
-    stdscr.refresh()
+@timed("render")
+def draw_game(renderer, board, piece, score):
+    """
+    Draws the enhanced game state to the screen. The border is drawn once,
+    the info panel and the next piece only when they change, and the board
+    every frame; the renderer then sends only the cells that differ.
+    """
+    stdscr = renderer.frame
+
+    # a color pair still on screen was given to another color, repaint
+    if color_pairs and color_pairs.evicted:
+        color_pairs.evicted = False
+        renderer.invalidate()
+
+    if not layout.fits:
+        if renderer.region_changed("chrome", layout):
+            stdscr.erase()
+            try:
+                stdscr.addstr(0, 0, "Terminal too small, please enlarge it"[:layout.width - 1])
+            except curses.error:
+                pass
+        renderer.present()
+        return
+
+    # static chrome, until the screen is invalidated or resized
+    if renderer.region_changed("chrome", layout):
+        stdscr.erase()
+        draw_border(stdscr)
+        if layout.panel:
+            try:
+                draw_preview_box(stdscr, 1, layout.panel_x)
+            except curses.error:
+                pass
+
+    # draw enhanced game info and held piece when any of it changed
+    info = (score, level, total_lines, combo_count, color, bcgd, held_shape, held_color,
+            coalescer and (coalescer.rate, coalescer.skipped // 100))
+    info_changed = renderer.region_changed("info", info)
+    if info_changed:
+        stdscr.erase_region(0, 0, 1, stdscr.width)
+        stdscr.erase_region(layout.info_y, layout.panel_x, stdscr.height, stdscr.width)
+        hold_y = draw_game_info(stdscr, score)
+        if layout.panel:
+            draw_hold_piece(stdscr, hold_y, layout.panel_x)
+
+    # draw next piece
+    # under frame budget pressure the preview waits, it is drawn once quality comes back
+    skip_preview = quality and quality.skips("preview")
+    if layout.panel and not skip_preview and renderer.region_changed("next", (next_shape, next_color)):
+        stdscr.erase_region(2, layout.panel_x + 1, THUMB_HEIGHT, THUMB_WIDTH)
+        try:
+            draw_thumbnail(stdscr, 1, layout.panel_x, next_shape, next_color)
+        except curses.error:
+            pass
+
+    draw_board(stdscr, board, piece)
+    # the info panel erase reaches into the overlay, redraw it along with the panel
+    if stats and layout.stats_pos and (renderer.region_changed("stats", stats.version) or info_changed):
+        draw_stats(stdscr)
+    renderer.present()
 
 
 def setup_colors():
@@ -848,17 +2328,124 @@ def handle_piece_movement(board, piece, key):
     return 0
 
 
+def shift_piece(board, piece, direction, cells=1):
+    """Move the piece up to cells columns left (-1) or right (1), return the columns moved."""
+    moved = 0
+    while moved < cells and not check_collision(board, piece["shape"], (piece["x"] + direction, piece["y"])):
+        piece["x"] += direction
+        moved += 1
+    if moved:
+        sound_piece_move()
+    return moved
+
+
+REPEAT_DELAY_TICKS = 35  # longest terminal key repeat delay, a repeat after that is a new press
+RELEASE_TICKS = 5  # a held key counts as released after this long without a repeat
+
+
+def ms_to_ticks(ms):
+    """Milliseconds in logic ticks, at least one tick unless ms is 0."""
+    return max(1, round(ms * TICK_RATE / 1000)) if ms else 0
+
+
+class AutoShift:
+    """
+    Delayed auto shift and auto repeat timers for one key group (left/right
+    or down), counted in logic ticks. Terminals send no key releases, so a
+    key counts as held once three of its events arrive with the last two
+    within RELEASE_TICKS, and as released when the repeats stop; the shift
+    therefore never starts before the terminal's key repeat delay, whatever
+    das is. Once the repeats are late the key may be up, so only one more
+    cell is shifted until the next one. Callers that know the real key
+    state, like bots replaying inputs, pass held=True and call release().
+    """
+
+    def __init__(self, das, arr):
+        self.das = das
+        self.arr = arr
+        self.direction = 0
+        self.held = False
+        self.idle = 0
+        self.charge = 0
+        self.repeat = 0
+        self.maybe_repeat = False
+        self.gap = RELEASE_TICKS  # ticks between the last two repeats
+        self.coasted = False
+
+    def press(self, direction, held=False):
+        """Key event for direction, return True if it should move the piece once."""
+        same = direction == self.direction
+        if same and (self.held or self.maybe_repeat) and self.idle <= RELEASE_TICKS:
+            # terminal key repeat, the timers move the piece from now on
+            self.held = True
+            self.maybe_repeat = False
+            self.gap = max(1, self.idle)
+            self.coasted = False
+            self.idle = 0
+            return False
+        if same and not self.held and self.idle <= REPEAT_DELAY_TICKS:
+            # the terminal's first repeat or a second tap, tick() tells them apart
+            self.maybe_repeat = True
+            self.idle = 0
+            return False
+        self.maybe_repeat = False
+        if not same or self.idle > REPEAT_DELAY_TICKS:
+            self.charge = 0
+            self.repeat = 0
+        self.direction = direction
+        self.held = held
+        self.gap = RELEASE_TICKS
+        self.coasted = False
+        self.idle = 0
+        return True
+
+    def release(self):
+        self.direction = 0
+        self.held = False
+
+    def tick(self):
+        """Advance one tick, return the cells to shift (COLS for all the way)."""
+        if not self.direction:
+            return 0
+        self.idle += 1
+        self.charge += 1
+        if self.maybe_repeat and self.idle > RELEASE_TICKS:
+            # no repeats followed, it was a second tap
+            self.maybe_repeat = False
+            return 1
+        if self.idle > (RELEASE_TICKS if self.held else REPEAT_DELAY_TICKS):
+            self.release()
+            return 0
+        if not self.held or self.charge < self.das:
+            return 0
+        if self.arr == 0:
+            cells = COLS
+        else:
+            self.repeat += 1
+            if self.repeat < self.arr:
+                return 0
+            self.repeat = 0
+            cells = 1
+        if self.idle > self.gap:
+            # the next repeat is late, the key may be up already
+            if self.coasted:
+                return 0
+            self.coasted = True
+            return 1
+        return cells
+
+
 def handle_hold_piece(piece):
     """Handle piece holding."""
-    global can_hold, held_shape
+    global can_hold, held_shape, held_color
     if can_hold:
         if held_shape is None:
-            held_shape = piece["shape"]
+            held_shape, held_color = piece["shape"], piece["color"]
             piece.update(new_piece())
         else:
-            temp_shape = piece["shape"]
-            piece["shape"] = held_shape
-            held_shape = temp_shape
+            temp_shape, temp_color = piece["shape"], piece["color"]
+            piece["shape"], piece["color"] = held_shape, held_color
+            held_shape, held_color = temp_shape, temp_color
             piece["x"] = COLS // 2 - len(piece["shape"][0]) // 2
             piece["y"] = 0
         can_hold = False
@@ -888,8 +2475,8 @@ def handle_hard_drop(board, piece):
     return cells_dropped * 2
 
 
-def show_game_over_screen(stdscr, score):
-    """Display enhanced game over screen."""
+def show_game_over_screen(stdscr, score, menu=True):
+    """Display enhanced game over screen, return "again", "menu" or "quit"."""
     global bcgd
     stdscr.nodelay(0)
     curses.start_color()
@@ -914,26 +2501,32 @@ def show_game_over_screen(stdscr, score):
 
     stats_y = art_start_y + len(GAME_OVER_ART) + 2
     if stats_y < max_y - 4:
-        stdscr.addstr(stats_y, (max_x - len(final_score_text)) //
-                      2, final_score_text, curses.color_pair(8) | curses.A_BOLD)
-        stdscr.addstr(stats_y + 1, (max_x - len(level_text)) //
-                      2, level_text, curses.color_pair(7))
-        stdscr.addstr(stats_y + 2, (max_x - len(lines_text)) //
-                      2, lines_text, curses.color_pair(7))
+        if len(final_score_text) < max_x:
+            stdscr.addstr(stats_y, (max_x - len(final_score_text)) //
+                          2, final_score_text, curses.color_pair(8) | curses.A_BOLD)
+        if len(level_text) < max_x:
+            stdscr.addstr(stats_y + 1, (max_x - len(level_text)) //
+                          2, level_text, curses.color_pair(7))
+        if len(lines_text) < max_x:
+            stdscr.addstr(stats_y + 2, (max_x - len(lines_text)) //
+                          2, lines_text, curses.color_pair(7))
 
     # Exit instruction
-    exit_text = "Press 'Q' to quit"
-    if stats_y + 4 < max_y - 1:
+    exit_text = "R: play again   M: menu   Q: quit" if menu else "R: play again   Q: quit"
+    if stats_y + 4 < max_y - 1 and len(exit_text) < max_x:
         stdscr.addstr(stats_y + 4, (max_x - len(exit_text)) // 2,
                       exit_text, curses.color_pair(6) | curses.A_BLINK)
 
     stdscr.refresh()
 
-    # wait for 'q' key specifically
+    # wait for a choice, enter plays again too
+    choices = {ord('r'): "again", ord('R'): "again", 10: "again", ord('q'): "quit", ord('Q'): "quit"}
+    if menu:
+        choices.update({ord('m'): "menu", ord('M'): "menu"})
     while True:
         key = stdscr.getch()
-        if key == ord('q') or key == ord('Q'):
-            break
+        if key in choices:
+            return choices[key]
 
 
 def show_pause_screen(stdscr):
@@ -970,10 +2563,12 @@ def show_pause_screen(stdscr):
 
     inst_y = art_start_y + len(PAUSE_ART) + 2
     if inst_y < max_y - 3:
-        stdscr.addstr(inst_y, (max_x - len(resume_text)) // 2,
-                      resume_text, curses.color_pair(10) | curses.A_BLINK)
-        stdscr.addstr(inst_y + 1, (max_x - len(quit_text)) //
-                      2, quit_text, curses.color_pair(10))
+        if len(resume_text) < max_x:
+            stdscr.addstr(inst_y, (max_x - len(resume_text)) // 2,
+                          resume_text, curses.color_pair(10) | curses.A_BLINK)
+        if len(quit_text) < max_x:
+            stdscr.addstr(inst_y + 1, (max_x - len(quit_text)) //
+                          2, quit_text, curses.color_pair(10))
 
     stdscr.refresh()
 
@@ -997,88 +2592,371 @@ def show_pause_screen(stdscr):
     stdscr.timeout(20)
 
 
-def main(stdscr):
-    global next_shape
-    global vol
-    next_shape = random.choice(SHAPES)  # initialize the first piece
-    """Main game loop."""
+def surface_rank(heights, rows, shape, x, y):
+    """Height plus bumpiness of the stack once shape landed at (x, y)."""
+    after = heights[:]
+    for c in range(len(shape[0])):
+        after[x + c] = rows - y - min(row for row in range(len(shape)) if shape[row][c])
+    return max(after) + sum(abs(a - b) for a, b in zip(after, after[1:]))
+
+
+def choose_placement(board, shape, index):
+    """
+    Pick where the bot drops a piece: the flattest and lowest of the hole
+    free resting places the skyline index knows of, or when there are none
+    the landing over all rotations and columns that leaves the fewest
+    holes, then the flattest and lowest stack.
+    Returns (rotated shape, x), or None if the piece cannot be placed.
+    """
+    rows = len(board)
+    heights = column_heights(board)
+    i = index.shape_index(shape)
+    best = None
+    for _, _, rotated, x, y in index.placements(board, i):
+        rank = (surface_rank(heights, rows, rotated, x, y), -y)
+        if best is None or rank < best[0]:
+            best = (rank, rotated, x)
+    if best is not None:
+        return best[1], best[2]
+
+    for rotated in all_rotations(shape) if i is None else index.rotations[i]:
+        width = len(rotated[0])
+        # lowest block of every column of the shape
+        bottoms = [max(y for y in range(len(rotated)) if rotated[y][x]) for x in range(width)]
+        for x in range(len(heights) - width + 1):
+            # a straight drop stops at the first column that touches the stack
+            y = min(rows - heights[x + c] - 1 - bottoms[c] for c in range(width))
+            if y < 0:
+                continue
+            holes = sum(rows - heights[x + c] - 1 - bottoms[c] - y for c in range(width))
+            rank = (holes, surface_rank(heights, rows, rotated, x, y), -y)
+            if best is None or rank < best[0]:
+                best = (rank, rotated, x)
+    return None if best is None else (best[1], best[2])
+
+
+class BotGame:
+    """A game played by a simple bot, as shown in the spectator view."""
+
+    def __init__(self, seed, index):
+        self.generator = PieceGenerator(SHAPES, SAMPLER, seed, args.bag, args.preview)
+        self.index = index
+        self.games = 0
+        self.restart()
+
+    def restart(self):
+        self.board = create_board()
+        self.score = 0
+        self.lines = 0
+        self.games += 1
+        self.spawn()
+
+    def spawn(self):
+        shape, piece_color = self.generator.pop()
+        placement = choose_placement(self.board, shape, self.index)
+        if placement is None:
+            placement = (shape, COLS // 2 - len(shape[0]) // 2)
+        self.piece = {"shape": placement[0], "x": placement[1], "y": 0, "color": piece_color}
+        if check_collision(self.board, self.piece["shape"], (self.piece["x"], 0)):
+            self.restart()  # game over, the next game starts right away
+
+    def step(self):
+        """Advance the game by one row of gravity."""
+        piece = self.piece
+        if not check_collision(self.board, piece["shape"], (piece["x"], piece["y"] + 1)):
+            piece["y"] += 1
+            return
+        self.board, lines_cleared = clear_lines(lock_piece(self.board, piece))
+        self.lines += lines_cleared
+        self.score += calculate_score(lines_cleared, 0, 0)
+        self.spawn()
+
+    def rows(self):
+        """Board rows with the falling piece drawn in."""
+        piece = self.piece
+        return overlay_piece(list(self.board), piece["shape"], piece["x"], piece["y"], piece["color"])
+
+
+def draw_spectator(renderer, games, half_blocks=False):
+    """Draw all games tiled on the screen and present them as one frame."""
+    screen = renderer.frame
+    tile_height = (ROWS + 1) // 2 if half_blocks else ROWS
+    per_row = max(1, (screen.width + 1) // (COLS + 1))
+    shown = min(len(games), per_row * max(0, (screen.height - 1) // (tile_height + 1)))
+
+    if renderer.region_changed("chrome", shown):
+        screen.erase()
+        # separators between the tiles
+        for i in range(shown):
+            top = 1 + (i // per_row) * (tile_height + 1)
+            left = (i % per_row) * (COLS + 1)
+            for y in range(top, top + tile_height + 1):
+                try:
+                    screen.addstr(y, left + COLS, BORDER_CHAR)
+                except curses.error:
+                    pass
+
+    total_lines = sum(game.lines for game in games)
+    total_games = sum(game.games for game in games)
+    header = (f"Spectating {len(games)} {name_of_game}is games ({shown} shown) | "
+              f"games: {total_games} | lines: {total_lines} | Q to quit")
+    screen.erase_region(0, 0, 1, screen.width)
+    try:
+        screen.addstr(0, 0, header[:screen.width - 1])
+    except curses.error:
+        pass
+
+    blank = [0] * COLS
+    for i in range(shown):
+        game = games[i]
+        top = 1 + (i // per_row) * (tile_height + 1)
+        left = (i % per_row) * (COLS + 1)
+        rows = game.rows()
+        try:
+            for y in range(tile_height):
+                if half_blocks:
+                    bottom = rows[2*y + 1] if 2*y + 1 < ROWS else blank
+                    text = tile_row_string(rows[2*y], bottom)
+                else:
+                    text = tile_row_string(rows[y])
+                screen.addstr(top + y, left, text)
+            screen.addstr(top + tile_height, left, f"{game.score:<{COLS}}"[:COLS])
+        except curses.error:
+            pass
+
+    renderer.present()
+
+
+def spectate(stdscr):
+    """Spectator view: runs args.spectate bot games and shows them all at once."""
+    curses.curs_set(0)
+    setup_colors()
+    curses.start_color()
+    curses.init_pair(1, color, bcgd)
+    stdscr.bkgd(' ', curses.color_pair(1) | curses.A_BOLD)
+    stdscr.nodelay(1)
+    stdscr.timeout(20)
+    renderer = RENDERERS[args.renderer](stdscr)
+
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+    index = SkylineIndex(SHAPES)  # shared by all the bots
+    games = [BotGame(seed + i, index) for i in range(args.spectate)]
+    while True:
+        key = stdscr.getch()
+        if key == ord('q') or key == ord('Q'):
+            break
+        for game in games:
+            game.step()
+        draw_spectator(renderer, games, args.half_blocks)
+
+
+def read_keys(stdscr, timeout, limit=0):
+    """
+    Wait up to timeout milliseconds for a key, then take every key that is
+    already queued, at most limit keys if limit is set.
+    """
+    stdscr.timeout(timeout)
+    keys = []
+    key = stdscr.getch()
+    if key != -1:
+        stdscr.timeout(0)
+    while key != -1:
+        keys.append(key)
+        if limit and len(keys) >= limit:
+            break
+        key = stdscr.getch()
+    return keys
+
+
+def reset_game_state():
+    """Reset the global game state for a new game in the same session."""
+    global level, total_lines, combo_count, last_action_was_clear
+    global can_hold, held_shape, held_color, is_paused
+    level = 0
+    total_lines = 0
+    combo_count = 0
+    last_action_was_clear = False
+    can_hold = True
+    held_shape = None
+    held_color = 1
+    is_paused = False
+
+
+def setup_game(stdscr):
+    """Prepare curses, sound and colors for a game and return its renderer."""
+    global generator, coalescer, quality
+    reset_game_state()
+    generator = PieceGenerator(SHAPES, SAMPLER, args.seed, args.bag, args.preview)
     # setup curses
     curses.curs_set(0)
-    global level, total_lines, combo_count, last_action_was_clear, can_hold
 
-    # initialize sound with selected music
-    init_sound(getattr(args, 'music', None))
+    # initialize sound with selected music, in the background
+    start_sound(getattr(args, 'music', None))
 
     setup_colors()
     curses.start_color()
     curses.init_pair(1, color, bcgd)  # set color pair for blocks
     stdscr.bkgd(' ', curses.color_pair(1) | curses.A_BOLD)
     stdscr.nodelay(1)
-    stdscr.timeout(20)  # game tick speed like PAL
+    init_color_pairs()
+    update_layout(stdscr)
+    renderer = RENDERERS[args.renderer](stdscr)
+    coalescer = FrameCoalescer(renderer) if args.adaptive else None
+    if args.frame_budget:
+        quality = QualityGovernor(args.frame_budget / 1000, args.degrade)
+    return renderer
 
-    # game state initialization
-    board = create_board()
-    piece = new_piece()
-    score = 0
-    game_over = False
-    fall_counter = 0
-    fall_speed = 36  # starting speed, lower is faster
 
-    if args.n < 4:
-        fall_speed = 36 - 6*(4-args.n)
+class Game:
+    """
+    State of the game being played and the rules that advance it, shared by
+    the blocking loop in main() and the asyncio loop in main_async().
+    """
 
-    while not game_over:
-        key = stdscr.getch()
-        fall_counter += 1
+    def __init__(self, stdscr, renderer, clock):
+        self.stdscr = stdscr
+        self.renderer = renderer
+        self.clock = clock
+        self.board = create_board()
+        self.piece = new_piece()
+        self.score = 0
+        self.over = False
+        self.fall_counter = 0
+        self.fall_speed = 36  # starting speed, lower is faster
+
+        if args.n < 4:
+            self.fall_speed = 36 - 6*(4-args.n)
+
+        self.shift = self.soft_drop = None
+        if args.das is not None:
+            self.shift = AutoShift(ms_to_ticks(args.das), ms_to_ticks(args.arr))
+            self.soft_drop = AutoShift(0, 0)
+        self.dirty = True  # state changed since the last frame
+        self.pending = []  # keys read after a hard drop
+        self.work = 0.0  # seconds of input, logic and drawing since the last frame, for --frame-budget
+        self.keys_start = 0.0
+
+    def locking(self):
+        """True while a hard dropped piece waits for the tick that locks it."""
+        return self.fall_counter >= self.fall_speed
+
+    def ticks_ahead(self):
+        """Logic ticks until something happens without input."""
+        if self.shift and (self.shift.direction or self.soft_drop.direction):
+            return 1  # the auto shift timers run every tick
+        return self.fall_speed - self.fall_counter
+
+    @timed("input")
+    def handle_keys(self, keys):
+        """Apply keys and add the time taken, sounds included, to the frame's work."""
+        self.keys_start = time.perf_counter()
+        self.apply_keys(keys)
+        self.work += time.perf_counter() - self.keys_start
+
+    def apply_keys(self, keys):
+        """Apply keys in order, keys after a hard drop wait until it locked."""
+        global vol
+        if self.pending:
+            if self.locking():
+                self.pending += keys
+                return
+            keys, self.pending = self.pending + keys, []
+        if keys:
+            self.dirty = True
+
+        board, piece = self.board, self.piece
+        for i, key in enumerate(keys):
+            if key == ord('q') or key == ord('Q'):
+                self.over = True
+                break
+            elif self.shift and key in [curses.KEY_LEFT, curses.KEY_RIGHT]:
+                direction = -1 if key == curses.KEY_LEFT else 1
+                if self.shift.press(direction):
+                    shift_piece(board, piece, direction)
+            elif self.soft_drop and key == curses.KEY_DOWN:
+                if self.soft_drop.press(1):
+                    self.fall_counter = 0
+                    self.score += handle_piece_movement(board, piece, key)
+            elif key in [curses.KEY_LEFT, curses.KEY_RIGHT, curses.KEY_DOWN, curses.KEY_UP]:
+                if key == curses.KEY_DOWN:
+                    self.fall_counter = 0  # reset fall counter for soft drop
+                self.score += handle_piece_movement(board, piece, key)
+            elif key == ord('c') or key == ord('C'):
+                handle_hold_piece(piece)
+            elif key in [ord('k'), ord('j'), ord('u'), ord('i')]:
+                handle_color_change(self.stdscr, key)
+                self.renderer.invalidate()
+            elif key == 10:  # hard drop
+                self.fall_counter = self.fall_speed
+                self.score += handle_hard_drop(board, piece)
+                # the remaining keys wait until the piece has locked
+                self.pending = keys[i + 1:]
+                break
+            elif key == ord('p') or key == ord('P'):
+                gc_safe_point()
+                show_pause_screen(self.stdscr)
+                if stats:
+                    stats.skip_frame()  # waiting for the key is not input time
+                self.work = 0.0
+                self.keys_start = time.perf_counter()
+                # the terminal may have been resized while paused
+                update_layout(self.stdscr)
+                self.renderer.resize()
+                self.clock.reset()
+            elif key == curses.KEY_RESIZE:
+                update_layout(self.stdscr)
+                self.renderer.resize()
+            elif key == ord('m') or key == ord('M'):
+                # Toggle all sound on/off
+                toggle_all_sound()
+            elif key == curses.KEY_PPAGE or key == curses.KEY_NPAGE:
+                # Volume control with Page Up/Page Down
+                if PYGAME_AVAILABLE:
+                    vol += 0.1 if key == curses.KEY_PPAGE else -0.1
+                    if vol > 1 or vol < 0:
+                        vol = max(0, min(1, vol))
+                        play_sound_effect(440, 100)
+                    if sound_enabled and sound_on:
+                        try:
+                            pygame.mixer.music.set_volume(vol)
+                        except:
+                            pass
 
-        # --- handle user input ---
-        if key == ord('q') or key == ord('Q'):
-            break
-        elif key in [curses.KEY_LEFT, curses.KEY_RIGHT, curses.KEY_DOWN, curses.KEY_UP]:
-            if key == curses.KEY_DOWN:
-                fall_counter = 0  # reset fall counter for soft drop
-            score += handle_piece_movement(board, piece, key)
-        elif key == ord('c') or key == ord('C'):
-            handle_hold_piece(piece)
-        elif key in [ord('k'), ord('j'), ord('u'), ord('i')]:
-            handle_color_change(stdscr, key)
-        elif key == 10:  # hard drop
-            fall_counter = fall_speed
-            score += handle_hard_drop(board, piece)
-        elif key == ord('p') or key == ord('P'):
-            show_pause_screen(stdscr)
-        elif key == ord('m') or key == ord('M'):
-            # Toggle all sound on/off
-            toggle_all_sound()
-        elif key == curses.KEY_PPAGE or key == curses.KEY_NPAGE:
-            # Volume control with Page Up/Page Down
-            if PYGAME_AVAILABLE:
-                vol += 0.1 if key == curses.KEY_PPAGE else -0.1
-                if vol > 1 or vol < 0:
-                    vol = max(0, min(1, vol))
-                    play_sound_effect(440, 100)
-                if sound_enabled and sound_on:
-                    try:
-                        pygame.mixer.music.set_volume(vol)
-                    except:
-                        pass
-
-        # --- game logic (automatic drop) ---
-        if fall_counter >= fall_speed:
-            fall_counter = 0
+    def tick(self):
+        """Advance the game by one logic tick (automatic drop)."""
+        global level, total_lines, combo_count, last_action_was_clear, can_hold
+        board, piece = self.board, self.piece
+        self.fall_counter += 1
+        gravity = self.fall_speed
+        if self.shift:
+            cells = self.shift.tick()
+            if cells and shift_piece(board, piece, self.shift.direction, cells):
+                self.dirty = True
+            if self.soft_drop.tick() and not self.soft_drop.held:
+                # a second tap of down, once no repeats followed it
+                self.fall_counter = 0
+                self.score += handle_piece_movement(board, piece, curses.KEY_DOWN)
+                self.dirty = True
+            if self.soft_drop.held:
+                gravity = max(1, self.fall_speed // args.sdf)
+        if self.fall_counter >= gravity:
+            self.fall_counter = 0
+            self.dirty = True
             if not check_collision(board, piece["shape"], (piece["x"], piece["y"] + 1)):
                 piece["y"] += 1
+                if gravity < self.fall_speed:
+                    self.score += 1  # soft drop bonus
             else:
                 # piece has landed, lock it
                 sound_piece_lock()
                 board = lock_piece(board, piece)
-                board, lines_cleared = clear_lines(board)
+                self.board, lines_cleared = clear_lines(board)
 
                 # handle scoring with combo system
                 if lines_cleared > 0:
 
                     if lines_cleared + total_lines < 5+level:
-                        sound_line_clear(lines_cleared)
+                        play_jingle(sound_line_clear, lines_cleared)
                     # if last action was also a line clear, increment combo
                     if last_action_was_clear:
                         combo_count += 1
@@ -1088,7 +2966,7 @@ def main(stdscr):
                     # calculate score with level and combo bonuses
                     line_score = calculate_score(
                         lines_cleared, level, combo_count)
-                    score += line_score
+                    self.score += line_score
                     total_lines += lines_cleared
                     last_action_was_clear = True
                 else:
@@ -1097,33 +2975,504 @@ def main(stdscr):
                     last_action_was_clear = False
 
                 # get new piece and allow holding again
-                piece = new_piece()
+                self.piece = new_piece()
                 can_hold = True
 
                 # check for game over
-                if check_collision(board, piece["shape"], (piece["x"], piece["y"])):
-                    game_over = True
+                if check_collision(self.board, self.piece["shape"], (self.piece["x"], self.piece["y"])):
+                    self.over = True
+                    return
 
         if total_lines >= 5+level:
             old_level = level
             level += 1
             total_lines -= 4+level
             # increase speed every 10 lines cleared
-            fall_speed = max(2, floor(fall_speed * 0.855))
+            self.fall_speed = max(2, floor(self.fall_speed * 0.855))
             if level != old_level:
-                sound_level_up()
+                play_jingle(sound_level_up)
+
+    @timed("logic")
+    def run_ticks(self):
+        """Run the logic ticks that are due on the clock."""
+        start = time.perf_counter()
+        for _ in range(self.clock.ticks()):
+            self.tick()
+            if self.over:
+                break
+        self.work += time.perf_counter() - start
+
+    def draw(self):
+        """Draw changes at the frame rate, unless the terminal is still busy with earlier frames."""
+        if self.dirty and self.clock.frame_due() and (coalescer is None or coalescer.ready()):
+            start = time.perf_counter()
+            draw_game(self.renderer, self.board, self.piece, self.score)
+            self.dirty = False
+            if quality:
+                quality.frame_done(self.work + time.perf_counter() - start)
+            self.work = 0.0
+            if stats:
+                stats.end_frame()
+            if coalescer:
+                coalescer.drawn()
+            # the frame is out, so spawning finds the pieces already made
+            generator.refill()
+
+    def finish(self):
+        """Show the game over screen, return the choice: "again", "menu" or "quit"."""
+        gc_safe_point()
+        play_jingle(sound_game_over)
+        return show_game_over_screen(self.stdscr, self.score, can_change_game())
+
+
+def main(stdscr):
+    """Main game loop."""
+    renderer = setup_game(stdscr)
+    clock = GameClock(TICK_RATE, args.fps)
+    game = Game(stdscr, renderer, clock)
+    with tuned_gc():
+        play(game)
+    return game.finish()
+
+
+def play(game):
+    """Run the game until it is over, in one blocking loop."""
+    stdscr, clock = game.stdscr, game.clock
+    while not game.over:
+        if game.pending and not game.locking():
+            timeout = 0  # the held back keys can go now
+        else:
+            # sleep until gravity is due or a key arrives, or until the next frame if one is pending
+            timeout = clock.timeout(game.ticks_ahead(), game.dirty)
+        # then take every key that is already queued
+        game.handle_keys(read_keys(stdscr, timeout, args.max_keys))
+        if game.over:
+            break
+        game.run_ticks()
+        game.draw()
+
+
+RESIZE_POLL = 0.25  # seconds between checks for a resize while no key arrives
+
+
+async def input_task(game, changed):
+    """Read keys whenever stdin becomes readable and apply them."""
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    loop.add_reader(sys.stdin.fileno(), readable.set)
+    try:
+        while not game.over:
+            # curses reports a resize through getch, but stdin stays quiet
+            try:
+                await asyncio.wait_for(readable.wait(), RESIZE_POLL)
+            except asyncio.TimeoutError:
+                pass
+            readable.clear()
+            keys = read_keys(game.stdscr, 0, args.max_keys)
+            if keys:
+                game.handle_keys(keys)
+                changed.set()
+    finally:
+        loop.remove_reader(sys.stdin.fileno())
+
+
+async def gravity_task(game, changed, redraw):
+    """Run logic ticks, sleeping until the next one matters or input arrives."""
+    while not game.over:
+        timeout = game.clock.timeout(game.ticks_ahead(), False) / 1000
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        changed.clear()
+        # keys held back after a hard drop are applied once the piece locked
+        if game.pending and not game.locking():
+            game.handle_keys([])
+        game.run_ticks()
+        if game.dirty:
+            redraw.set()
+
+
+async def render_task(game, redraw):
+    """Draw a frame whenever the state changed, at most at the frame rate."""
+    while not game.over:
+        await redraw.wait()
+        redraw.clear()
+        while game.dirty and not game.over:
+            game.draw()
+            if game.dirty:
+                await asyncio.sleep(max(0, game.clock.next_frame - time.monotonic_ns()) / 1e9)
+
+
+async def sound_task():
+    """Play queued jingles in a worker thread, so their note waits do not stall the game."""
+    loop = asyncio.get_running_loop()
+    while True:
+        func, jingle_args = await sound_queue.get()
+        await loop.run_in_executor(None, func, *jingle_args)
+
+
+async def play_async(stdscr, *extra_tasks):
+    """
+    The game as cooperating asyncio tasks for input, gravity, rendering and
+    sound on the same Game state. extra_tasks are coroutine functions called
+    with the game, e.g. to serve network spectators; they are cancelled when
+    the game ends.
+    """
+    global sound_queue
+    renderer = setup_game(stdscr)
+    game = Game(stdscr, renderer, GameClock(TICK_RATE, args.fps))
+    changed = asyncio.Event()
+    redraw = asyncio.Event()
+    redraw.set()
+    sound_queue = asyncio.Queue()
+
+    loops = [asyncio.create_task(gravity_task(game, changed, redraw)),
+             asyncio.create_task(input_task(game, changed)),
+             asyncio.create_task(render_task(game, redraw))]
+    background = [asyncio.create_task(sound_task())]
+    background += [asyncio.create_task(task(game)) for task in extra_tasks]
+    try:
+        with tuned_gc():
+            done, _ = await asyncio.wait(loops, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in loops + background:
+            task.cancel()
+        await asyncio.gather(*loops, *background, return_exceptions=True)
+        sound_queue = None
+    return game.finish()
+
+
+def main_async(stdscr):
+    """Main game loop on asyncio (--asyncio)."""
+    global asyncio
+    import asyncio
+    return asyncio.run(play_async(stdscr))
+
+
+def can_change_game():
+    """The menu may pick another game unless a shape file or a weight list ties it to n."""
+    return not args.shapes and args.weights in ("shape", "order")
+
+
+def session(stdscr):
+    """
+    Menu, game and game over in one curses session until the player quits.
+    Shape tables, mixer and music stay loaded, so a new game starts at once.
+    """
+    choice = "menu" if args.n is None else "again"
+    if choice == "menu":
+        start_sound(NO_MUSIC)
+    welcome = True
+    while choice != "quit":
+        if choice == "menu":
+            selected_n, selected_ext, selected_mix, selected_music = show_menu(stdscr, welcome)
+            welcome = False
+            if selected_n is None:
+                return
+            if (selected_n, selected_ext, selected_mix) != (args.n, args.e, args.m):
+                args.n, args.e, args.m = selected_n, selected_ext, selected_mix
+                initialize_shapes_and_dimensions()
+            args.music = selected_music
+        choice = (main_async if args.asyncio else main)(stdscr)
+
+
+ANALYSIS_VERSION = 1
+ANALYSIS_CHUNK = 1000  # shapes per task, so big sets spread over all workers
+
+
+def analysis_digest(k, ext):
+    """Fingerprint of a shape set, cached results are reused while it matches."""
+    if 2*k <= len(ps.poly):
+        return hashlib.sha1(repr(shapes_for_order(k, ext)).encode()).hexdigest()
+    return f"generated-{k}{'e' if ext else ''}"
+
+
+def shape_stats(shapes, cols):
+    """Statistics for a chunk of shapes, merged by merge_shape_stats."""
+    index = SkylineIndex(shapes)
+    stats = {
+        "shapes": len(shapes),
+        "symmetry": {"4-fold": 0, "2-fold": 0, "none": 0},
+        "width": 0,
+        "height": 0,
+        "placements": 0,
+        "hole_free": len({entry[0] for entries in index.table.values() for entry in entries}),
+        "flat_fit": len({entry[0] for pattern, entries in index.table.items()
+                         if not any(pattern) for entry in entries}),
+        "patterns": set(index.table),
+    }
+    for shape in shapes:
+        rotations = {tuple(map(tuple, r)) for r in all_rotations(shape)}
+        stats["symmetry"][{1: "4-fold", 2: "2-fold"}.get(len(rotations), "none")] += 1
+        stats["width"] += len(shape[0])
+        stats["height"] += len(shape)
+        # resting positions on an empty board, one per column the rotation fits in
+        stats["placements"] += sum(max(0, cols - len(r[0]) + 1) for r in rotations)
+    return stats
+
+
+def merge_shape_stats(stats, other):
+    for key in ("shapes", "width", "height", "placements", "hole_free", "flat_fit"):
+        stats[key] += other[key]
+    for key in stats["symmetry"]:
+        stats["symmetry"][key] += other["symmetry"][key]
+    stats["patterns"] |= other["patterns"]
+    return stats
+
+
+def analyze_shape_sets(path, max_order, jobs):
+    """
+    Analyze every shape set up to max_order in a process pool and write the
+    report to path. Sets whose digest matches the cached report are skipped.
+    """
+    report = {"version": ANALYSIS_VERSION, "sets": {}}
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached.get("version") == ANALYSIS_VERSION:
+                report = cached
+        except (OSError, ValueError):
+            pass
+
+    todo = []
+    for k in range(1, max_order + 1):
+        for ext in (False, True):
+            name = f"{k}{'e' if ext else ''}"
+            digest = analysis_digest(k, ext)
+            if report["sets"].get(name, {}).get("digest") != digest:
+                todo.append((name, k, ext, digest))
+
+    # only the analysis needs the process pool, a game never pays for importing it
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # fork so the workers start instantly and share the loaded shape tables
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=max(1, jobs), mp_context=context) as pool:
+        shape_sets = pool.map(shapes_for_order,
+                              [k for _, k, _, _ in todo], [ext for _, _, ext, _ in todo])
+        tasks = []
+        for (name, k, ext, digest), shapes in zip(todo, shape_sets):
+            cols, _ = board_dimensions(k, ext)
+            chunks = [pool.submit(shape_stats, shapes[i:i + ANALYSIS_CHUNK], cols)
+                      for i in range(0, len(shapes), ANALYSIS_CHUNK)]
+            tasks.append((name, digest, chunks))
+
+        for name, digest, chunks in tasks:
+            stats = chunks[0].result()
+            for chunk in chunks[1:]:
+                merge_shape_stats(stats, chunk.result())
+            count = stats["shapes"]
+            report["sets"][name] = {
+                "digest": digest,
+                "shapes": count,
+                "symmetry": stats["symmetry"],
+                "avg_width": round(stats["width"] / count, 3),
+                "avg_height": round(stats["height"] / count, 3),
+                "hole_free": stats["hole_free"],
+                "flat_fit": stats["flat_fit"],
+                "skyline_patterns": len(stats["patterns"]),
+                "placements": stats["placements"],
+            }
+
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'set':>4} {'shapes':>7} {'4-fold':>7} {'2-fold':>7} {'none':>7} {'avg box':>11} "
+          f"{'hole-free':>10} {'flat-fit':>9} {'patterns':>9} {'placements':>11}")
+    for k in range(1, max_order + 1):
+        for ext in (False, True):
+            name = f"{k}{'e' if ext else ''}"
+            r = report["sets"][name]
+            sym = r["symmetry"]
+            box = f"{r['avg_width']:.2f}x{r['avg_height']:.2f}"
+            print(f"{name:>4} {r['shapes']:>7} {sym['4-fold']:>7} {sym['2-fold']:>7} {sym['none']:>7} {box:>11} "
+                  f"{r['hole_free']:>10} {r['flat_fit']:>9} {r['skyline_patterns']:>9} {r['placements']:>11}")
+    print(f"{len(todo)} sets analyzed, {2 * max_order - len(todo)} cached, report written to {path}")
+
+
+def benchmark_frames(renderer, frames, times=None):
+    """
+    Draw frames of a scripted game (fixed seed) and return the seconds spent,
+    adding the time of every frame to the times histogram if given.
+    """
+    global generator, held_shape
+    generator = PieceGenerator(SHAPES, SAMPLER, 0, args.bag, args.preview)
+    held_shape = None
+    board = create_board()
+    piece = new_piece()
+    score = 0
+    moves = [curses.KEY_LEFT, curses.KEY_UP, curses.KEY_RIGHT, curses.KEY_RIGHT]
+
+    start = frame_start = time.perf_counter()
+    for frame in range(frames):
+        if frame % 5 == 0:
+            handle_piece_movement(board, piece, moves[frame // 5 % len(moves)])
+        if frame % 3 == 0:
+            if not check_collision(board, piece["shape"], (piece["x"], piece["y"] + 1)):
+                piece["y"] += 1
+            else:
+                board, lines_cleared = clear_lines(lock_piece(board, piece))
+                score += calculate_score(lines_cleared, level, 0)
+                piece = new_piece()
+                if check_collision(board, piece["shape"], (piece["x"], piece["y"])):
+                    board = create_board()
+        draw_game(renderer, board, piece, score)
+        if times is not None:
+            now = time.perf_counter()
+            times.add(now - frame_start)
+            frame_start = now
+    return time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def pty_curses(height=50, width=120):
+    """
+    Real curses on a pseudo terminal of the given size, for the benchmark.
+    Yields stdscr and a function returning the bytes curses has sent so far.
+    Standard output is the terminal meanwhile, so nothing can be printed.
+    """
+    master, slave = os.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", height, width, 0, 0))
+    received = [0]
+
+    def drain():
+        while True:
+            try:
+                data = os.read(master, 65536)
+            except OSError:
+                return  # the terminal was closed
+            if not data:
+                return
+            received[0] += len(data)
+
+    def sent():
+        # wait for the reader to catch up with what curses has written
+        while True:
+            before = received[0]
+            time.sleep(0.02)
+            if received[0] == before:
+                return before
+
+    reader = threading.Thread(target=drain, daemon=True)
+    reader.start()
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    os.dup2(slave, 1)
+    os.environ.setdefault("TERM", "xterm-256color")
+    try:
+        stdscr = curses.initscr()
+        try:
+            curses.start_color()
+            yield stdscr, sent
+        finally:
+            curses.endwin()
+    finally:
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+        os.close(slave)
+        reader.join(1)
+        os.close(master)
+
+
+def benchmark_rendering(frames):
+    """
+    Rendering benchmark for every n and renderer backend. The ANSI backend
+    writes to /dev/null, curses draws on a pseudo terminal so its output is
+    what a terminal would receive. Call counts come from a recording screen.
+    """
+    rows = []
+    with pty_curses() as (stdscr, sent), open(os.devnull, "wb") as devnull:
+        for n in range(1, 7):
+            args.n = n
+            for name, renderer_class in RENDERERS.items():
+                def make_renderer(screen):
+                    screen.bkgd(' ', curses.color_pair(1) | curses.A_BOLD)
+                    update_layout(screen)
+                    if renderer_class is AnsiRenderer:
+                        return renderer_class(screen, fd=devnull.fileno())
+                    return renderer_class(screen)
+
+                with headless_curses():
+                    initialize_shapes_and_dimensions()
+                    curses.init_pair(1, color, bcgd)
+                    recording = RecordingScreen()
+                    benchmark_frames(make_renderer(recording), frames)
+                    calls = recording.calls.get("addstr", 0) / frames
+                    if renderer_class is AnsiRenderer:
+                        renderer = make_renderer(NullScreen())
+                        elapsed = benchmark_frames(renderer, frames)
+                        written = renderer.bytes_written / frames
+
+                if renderer_class is CursesRenderer:
+                    # what curses sends, renderer.bytes_written is only an estimate
+                    curses.init_pair(1, color, bcgd)
+                    before = sent()
+                    elapsed = benchmark_frames(make_renderer(stdscr), frames)
+                    written = (sent() - before) / frames
+                rows.append(f"{n:>2} {name:>8} {frames / elapsed:>10.0f} {calls:>13.1f} {written:>12.0f}")
+
+    print(f"{'n':>2} {'renderer':>8} {'frames/s':>10} {'addstr/frame':>13} {'bytes/frame':>12}")
+    print("\n".join(rows))
+
+    with headless_curses():
+        # frame time jitter of the last set with the default and the tuned collector
+        update_layout(NullScreen())
+        for label in ("default gc", "tuned gc"):
+            times = FrameHistogram()
+            with tuned_gc() if label == "tuned gc" else contextlib.nullcontext():
+                benchmark_frames(CursesRenderer(NullScreen()), frames, times)
+            print(f"\n{label}: {times.summary()}")
+            print("\n".join(times.lines()))
+
+
+# initialize game settings
+if args.analyze is not None:
+    analyze_shape_sets(args.analyze, max(6, args.n or 0), args.jobs)
+    exit(0)
+
+if args.benchmark is not None:
+    benchmark_rendering(args.benchmark)
+    exit(0)
+
+if args.export_shapes and args.n is None and not args.shapes:
+    parser.error("--export-shapes needs n or --shapes")
+
+if args.shapes:
+    # size the board for the largest shape in the file, a smaller n would not fit it
+    try:
+        args.n = max(args.n or 0, ShapeSetFile(args.shapes).max_order)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    args.music = None
+elif args.n is None and args.spectate:
+    args.n = 4
+    args.music = None
+else:
+    # music is chosen in the menu the session starts with when n is not given
+    if args.n is None and not can_change_game():
+        parser.error("a list for --weights needs n on the command line")
+    args.music = None
+
+try:
+    if args.n is not None:
+        initialize_shapes_and_dimensions()
+except (ValueError, OSError) as e:
+    parser.error(str(e))
 
-        # draw game
-        draw_game(stdscr, board, piece, score)
+if args.export_shapes:
+    write_shape_set(args.export_shapes, SHAPES, SHAPE_ORDERS)
+    print(f"Wrote {len(SHAPES)} shapes to {args.export_shapes}")
+    exit(0)
 
-    # game over
-    sound_game_over()
-    show_game_over_screen(stdscr, score)
-    cleanup_sound()
 
 def run():
     try:
-        curses.wrapper(main)
+        curses.wrapper(spectate if args.spectate else session)
     except curses.error as e:
         print("Error running curses.")
         print("Your terminal may not be supported, or it probably is too small.")
@@ -1133,6 +3482,9 @@ def run():
         cleanup_sound()
     finally:
         cleanup_sound()
+        # also after quitting from the pause screen, which exits right away
+        if stats:
+            print(stats.report())
 
 if __name__ == "__main__":
     run()